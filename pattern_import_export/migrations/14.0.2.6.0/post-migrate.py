@@ -0,0 +1,63 @@
+# Copyright 2022 Akretion (https://www.akretion.com).
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from openupgradelib import openupgrade
+
+
+def init_chunk_todo(env, pattern_files):
+    """Set the number of remaining chunks of the files being imported,
+    the files without remaining chunk are done
+    @return: the files with remaining chunks"""
+    todo = env["pattern.file"].browse()
+    for pattern_file in pattern_files:
+        nbr_chunk_todo = len(
+            pattern_file.chunk_ids.filtered(
+                lambda chunk: chunk.state in ("pending", "started")
+            )
+        )
+        pattern_file.nbr_chunk_todo = nbr_chunk_todo
+        if nbr_chunk_todo:
+            todo |= pattern_file
+        else:
+            pattern_file.set_import_done()
+    return todo
+
+
+@openupgrade.migrate()
+def migrate(env, version):
+    """The chunks of the files being imported now decrement the number of
+    remaining chunks of their file, it is initialized for all these files.
+    Without multi process, the job of a chunk used to enqueue the job of
+    the next one. The chunks are now imported by the job run_chunks of the
+    file, so these files get this job instead of their chunk jobs, that
+    would not enqueue the next chunk anymore."""
+    pattern_files = env["pattern.file"].search(
+        [
+            ("kind", "=", "import"),
+            ("state", "=", "pending"),
+            ("split_running", "=", False),
+            ("chunk_ids", "!=", False),
+        ]
+    )
+    sequential_files = pattern_files.filtered(
+        lambda pattern_file: not pattern_file.pattern_config_id.process_multi
+    )
+    if sequential_files:
+        chunks = sequential_files.chunk_ids
+        jobs = env["queue.job"].search(
+            [
+                ("model_name", "=", "pattern.chunk"),
+                ("method_name", "=", "run"),
+                ("state", "in", ("pending", "enqueued", "started")),
+            ]
+        )
+        jobs.filtered(lambda job: set(job.record_ids) & set(chunks.ids)).button_done()
+        # the import of a started chunk has been interrupted by the upgrade
+        chunks.filtered(lambda chunk: chunk.state == "started").write(
+            {"state": "pending"}
+        )
+    todo = init_chunk_todo(env, pattern_files)
+    for pattern_file in todo & sequential_files:
+        pattern_file.with_delay(
+            priority=pattern_file.pattern_config_id.job_priority
+        ).run_chunks()
@@ -2,9 +2,14 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import copy
 import logging
+from collections import defaultdict
+from datetime import date, datetime
+
+import psycopg2
 
 from odoo import _, api, models
 from odoo.exceptions import ValidationError
+from odoo.models import PGERROR_TO_OE
 from odoo.osv import expression
 
 from .common import IDENTIFIER_SUFFIX
@@ -12,6 +17,7 @@ from .common import IDENTIFIER_SUFFIX
 _logger = logging.getLogger(__name__)
 
 FLOAT_INF = float("inf")
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, date, datetime)
 
 
 def is_not_empty(item):
@@ -29,6 +35,52 @@ def is_not_empty(item):
         return True
 
 
+def get_path_steps(path):
+    """Return the steps to walk in the nested dict to reach the value of
+    a column: (name, None) for a dict, (name, position) for a list item"""
+    steps = []
+    previous_key = None
+    for key in path:
+        if not previous_key:
+            pass
+        elif isinstance(key, int):
+            steps.append((previous_key, key))
+        elif not isinstance(previous_key, int):
+            steps.append((previous_key, None))
+        previous_key = key
+    return tuple(steps)
+
+
+def set_path_value(res, steps, last, value):
+    current = res
+    for name, position in steps:
+        if position is None:
+            if name not in current:
+                current[name] = {}
+            current = current[name]
+        else:
+            if name not in current:
+                current[name] = []
+            if len(current[name]) < position:
+                current[name].append({})
+            current = current[name][position - 1]
+    current[last] = value
+
+
+def copy_load_values(value):
+    """Copy the containers (dict, list and command tuple) of the values to load,
+    the leaf values are immutable and shared with the original"""
+    if isinstance(value, dict):
+        return {key: copy_load_values(val) for key, val in value.items()}
+    elif isinstance(value, list):
+        return [copy_load_values(val) for val in value]
+    elif isinstance(value, tuple):
+        return tuple(copy_load_values(val) for val in value)
+    elif value is None or isinstance(value, IMMUTABLE_TYPES):
+        return value
+    return copy.deepcopy(value)
+
+
 class Base(models.AbstractModel):
     _inherit = "base"
 
@@ -41,23 +93,246 @@ class Base(models.AbstractModel):
     # in order to have explicit error
     # The issue is if the create/write method modify the dict vals
     # the modification will be kept and this can generate issue when loading one by one
-    # Do a deepcopy to avoid this issue
+    # Copy the values to avoid this issue, only the containers are copied
+    # as the create/write never modify the values themselves
     # TODO try to reproduce it on native odoo and open a ticket
 
     def _load_records_write(self, values):
-        return super()._load_records_write(copy.deepcopy(values))
+        pattern_config = self._context.get("pattern_config")
+        if pattern_config and pattern_config.get("one2many_diff"):
+            values = self._get_one2many_diff_values(values)
+        if pattern_config and pattern_config.get("skip_unchanged"):
+            values = self._get_changed_values(values)
+            if not set(values) - {"id"}:
+                pattern_config.setdefault("unchanged_ids", set()).add(self.id)
+                return
+        return super()._load_records_write(copy_load_values(values))
+
+    def _is_value_changed(self, field, value):
+        if field.type == "one2many" or field.type == "binary":
+            # the commands or the content are not compared
+            return True
+        elif field.type == "many2many":
+            current_ids = set(self[field.name].ids)
+            for command in value:
+                if command[0] == 6 and set(command[2]) == current_ids:
+                    continue
+                elif command[0] == 4 and command[1] in current_ids:
+                    continue
+                return True
+            return False
+        try:
+            new_value = field.convert_to_cache(value, self)
+        except (ValueError, TypeError):
+            return True
+        return new_value != field.convert_to_cache(self[field.name], self)
+
+    def _get_changed_values(self, values):
+        """Return the values that are different from the current values
+        of the record"""
+        return {
+            name: value
+            for name, value in values.items()
+            if name == "id"
+            or name not in self._fields
+            or self._is_value_changed(self._fields[name], value)
+        }
+
+    def _get_one2many_diff_commands(self, field, commands):
+        """Rewrite the commands of a purged one2many (starting with 5)
+        - existing lines are only updated if changed
+        - lines missing in the file are removed with the same command 3
+        as the purge (deleted or unlinked depending on the inverse field)
+        - new lines are created"""
+        line_ids = set(self[field.name].ids)
+        kept_ids = set()
+        result = []
+        for command in commands[1:]:
+            if command[0] == 4 and command[1] in line_ids:
+                # already linked
+                kept_ids.add(command[1])
+            elif command[0] == 1 and command[1] in line_ids:
+                kept_ids.add(command[1])
+                line = self.env[field.comodel_name].browse(command[1])
+                vals = line._get_changed_values(
+                    line._get_one2many_diff_values(command[2])
+                )
+                if vals:
+                    result.append((1, command[1], vals))
+            else:
+                result.append(command)
+        removed = [(3, line_id) for line_id in sorted(line_ids - kept_ids)]
+        return removed + result
+
+    def _get_one2many_diff_values(self, values):
+        """Return the values with the purged one2many synchronized in place"""
+        values = dict(values)
+        for name, commands in list(values.items()):
+            field = self._fields.get(name)
+            if field and field.type == "one2many" and commands and commands[0][0] == 5:
+                commands = self._get_one2many_diff_commands(field, commands)
+                if commands:
+                    values[name] = commands
+                else:
+                    values.pop(name)
+        return values
+
+    def _prefetch_records_to_update(self, data_list):
+        """Read in batch the current values of the records updated by the
+        load, they will be compared to the new values"""
+        xmlids = self._context["pattern_config"].get("xmlids") or {}
+        ids = set()
+        fnames = set()
+        line_fnames = defaultdict(set)
+        for data in data_list:
+            values = data["values"]
+            record_id = values.get("id") or xmlids.get((self._name, data.get("xml_id")))
+            if record_id:
+                ids.add(record_id)
+                fnames.update(values)
+                for name, value in values.items():
+                    field = self._fields.get(name)
+                    if field and field.type == "one2many" and value:
+                        for command in value:
+                            if command[0] == 1:
+                                line_fnames[name].update(command[2])
+        # the current lines of the one2many are read for the diff
+        fnames = [
+            name
+            for name in fnames
+            if name in self._fields and self._fields[name].type != "binary"
+        ]
+        if not ids or not fnames:
+            return
+        # the cache is invalidated as a failed batch attempt of the load
+        # may have left the values written in the cache
+        records = self.browse(ids)
+        records.invalidate_cache(fnames, records.ids)
+        records.read(fnames)
+        for name, names in line_fnames.items():
+            lines = records.mapped(name)
+            names = [
+                fname
+                for fname in names
+                if fname in lines._fields and lines._fields[fname].type != "binary"
+            ]
+            lines.invalidate_cache(names, lines.ids)
+            lines.read(names)
 
     def _load_records_create(self, values):
-        return super()._load_records_create(copy.deepcopy(values))
+        return super()._load_records_create(copy_load_values(values))
 
     def _load_records(self, data_list, update=False):
+        pattern_config = self._context.get("pattern_config")
+        if not pattern_config:
+            return super()._load_records(data_list, update=update)
+        pattern_config["pending_load"] = False
+        pattern_config["nbr_load"] = pattern_config.get("nbr_load", 0) + 1
+        if pattern_config.get("skip_unchanged") or pattern_config.get("one2many_diff"):
+            self._prefetch_records_to_update(data_list)
+        if pattern_config.get("bisect_retry") and len(data_list) > 1:
+            return self._load_records_bisect(
+                data_list,
+                update,
+                {"errors": 0, "done": 0, "stop": False, "bisecting": False},
+            )
+        return self._load_records_pattern(data_list, update)
+
+    def _load_records_pattern(self, data_list, update):
         records = super()._load_records(data_list, update=update)
-        if self._context.get("pattern_config"):
-            self._context["pattern_config"]["record_ids"] += records.ids
+        self._context["pattern_config"]["record_ids"] += records.ids
+        self._invalidate_db_id_cache(data_list)
         return records
 
+    def _load_records_bisect(self, data_list, update, state):
+        """Load the records in a savepoint, if it fails load each half
+        the same way. Isolating k failing rows costs O(k log n) loads
+        instead of the n loads of the row by row fallback of the native
+        load. The rows that fail alone are logged as in the native load.
+        @param state: dict shared by the recursive calls with the number
+        of errors and of rows processed and if the load is interrupted
+        @return: the records loaded"""
+        if state["stop"]:
+            return self.browse()
+        try:
+            with self.env.cr.savepoint():
+                records = self._load_records_pattern(data_list, update)
+            state["done"] += len(data_list)
+            return records
+        except Exception as e:
+            if isinstance(e, psycopg2.InternalError) and not state["bisecting"]:
+                # broken transaction on the whole batch, let the native
+                # load report it
+                raise
+            if len(data_list) == 1:
+                self._log_load_error(data_list[0], state, e)
+                return self.browse()
+        state["bisecting"] = True
+        half = len(data_list) // 2
+        return self._load_records_bisect(
+            data_list[:half], update, state
+        ) + self._load_records_bisect(data_list[half:], update, state)
+
+    def _log_load_error(self, data, state, error):
+        """Log the error of a row loaded alone with the same message than
+        the row by row fallback of the native load"""
+        log = self._context["pattern_config"]["log"]
+        info = data["info"]
+        state["done"] += 1
+        if isinstance(error, psycopg2.Warning):
+            log(dict(info, type="warning", message=str(error)))
+            return
+        if isinstance(error, psycopg2.Error):
+            if "fields" not in state:
+                state["fields"] = self.fields_get()
+            log(
+                dict(
+                    info,
+                    type="error",
+                    **PGERROR_TO_OE[error.pgcode](self, state["fields"], info, error),
+                )
+            )
+        else:
+            _logger.debug("Error while loading record", exc_info=error)
+            message = _("Unknown error during import:") + " %s: %s" % (
+                type(error),
+                error,
+            )
+            moreinfo = _("Resolve other errors first")
+            log(dict(info, type="error", message=message, moreinfo=moreinfo))
+        state["errors"] += 1
+        if state["errors"] >= 10 and (state["errors"] >= state["done"] / 10):
+            log(
+                {
+                    "type": "warning",
+                    "message": _(
+                        "Found more than 10 errors and more than one error per "
+                        "10 records, interrupted to avoid showing too many errors."
+                    ),
+                }
+            )
+            state["stop"] = True
+
+    def _invalidate_db_id_cache(self, data_list):
+        """Remove the cached lookups of the models written by the load"""
+        cache = self._context["pattern_config"].get("db_id_cache")
+        if not cache:
+            return
+        model_names = {self._name}
+        for data in data_list:
+            for name in data["values"]:
+                field = self._fields.get(name)
+                if field and field.type == "one2many":
+                    model_names.add(field.comodel_name)
+        for key in list(cache):
+            if key[0] in model_names:
+                del cache[key]
+
     def load(self, fields, data):
         result = super().load(fields, data)
+        pattern_config = self._context.get("pattern_config")
+        if pattern_config and pattern_config.get("unchanged_ids"):
+            result["nbr_unchanged"] = len(pattern_config["unchanged_ids"])
         if not result["ids"] and self._context.get("pattern_config", {}).get(
             "record_ids"
         ):
@@ -65,37 +340,61 @@ class Base(models.AbstractModel):
         return result
 
     def _pattern_format2json(self, row):
-        def convert_header_key(key):
-            return [int(k) if k.isdigit() else k for k in key.split("|")]
-
-        for key in ["id", ".id"]:
-            if key in row and row[key] is None:
-                row.pop(key)
-        res = {}
-        items = [(convert_header_key(k), v) for k, v in row.items()]
-        items.sort()
-        for keys, vals in items:
-            current = res
-            previous_key = None
-            for key in keys:
-                if not previous_key:
-                    previous_key = key
-                elif isinstance(key, int):
-                    if previous_key not in current:
-                        current[previous_key] = []
-                    if len(current[previous_key]) < key:
-                        current[previous_key].append({})
-                    try:
-                        current = current[previous_key][key - 1]
-                    except IndexError:
-                        raise
-                elif not isinstance(previous_key, int):
-                    if previous_key not in current:
-                        current[previous_key] = {}
-                    current = current[previous_key]
-                previous_key = key
-            current[keys[-1]] = vals
-        return self._post_process_key(res)
+        return self._post_process_key(self._pattern_format2dict(row))
+
+    def _pattern_format2dict(self, row):
+        return self._get_row_builder(tuple(row))(row) or {}
+
+    def _get_header_path(self, key):
+        # path of the headers of the pattern are precompiled
+        # other columns of the file are parsed on the fly
+        header_paths = self._context.get("pattern_config", {}).get("header_paths", {})
+        path = header_paths.get(key)
+        if path is None:
+            path = tuple(int(k) if k.isdigit() else k for k in key.split("|"))
+        return path
+
+    def _get_row_builder(self, keys):
+        """Analyse the columns of the file once and return a function that
+        build the nested dict of a row
+        - commented (#) and empty columns are dropped
+        - the path of each column is computed
+        - the steps to walk in the nested dict are precomputed in the order
+        of the path, so no sort or split is done for each row
+        @param keys: the keys of the rows
+        @return: function (row) -> nested dict or None if the row is empty
+        """
+        paths = []
+        for key in keys:
+            if key is None or key.startswith("#"):
+                continue
+            paths.append((self._get_header_path(key), key))
+        paths.sort()
+
+        columns = []
+        for path, key in paths:
+            # empty id and .id are removed
+            skip_none = key in ("id", ".id")
+            columns.append((key, get_path_steps(path), path[-1], skip_none))
+
+        def build_row(row):
+            values = []
+            not_empty = False
+            for key, _steps, _last, _skip_none in columns:
+                value = row[key]
+                if isinstance(value, str):
+                    value = value.strip()
+                not_empty = not_empty or bool(value)
+                values.append(value)
+            if not not_empty:
+                return None
+            res = {}
+            for (_key, steps, last, skip_none), value in zip(columns, values):
+                if not (skip_none and value is None):
+                    set_path_value(res, steps, last, value)
+            return res
+
+        return build_row
 
     def _clean_identifier_key(self, res, ident_keys):
         for key in ident_keys:
@@ -151,15 +450,17 @@ class Base(models.AbstractModel):
     def _post_process_o2m_fields(self, res, parent_do_not_exist):
         """Post process one2many field
         - remove all empty item
-        - post process key on each valid item (with the parent_id in domain)
+        - return the valid items to post process (with the parent_id in domain)
+        @return: list of (comodel, (subitem, subdomain, parent_do_not_exist))
         """
         if ".id" in res:
             parent_id = res[".id"]
         elif "id" in res:
-            parent_id = self.env.ref(res["id"]).id
+            parent_id = self._get_record_id_from_xmlid(res["id"])
         else:
             parent_id = None
 
+        subitems = []
         for key in res:
             field = self._fields.get(key)
             if field and field.type == "one2many":
@@ -171,13 +472,68 @@ class Base(models.AbstractModel):
                 for subitem in res[key]:
                     if is_not_empty(subitem):
                         valid_subitems.append(subitem)
-                        self.env[field._related_comodel_name]._post_process_key(
-                            subitem, subdomain, not bool(parent_id)
+                        subitems.append(
+                            (
+                                field._related_comodel_name,
+                                (subitem, subdomain, not bool(parent_id)),
+                            )
                         )
                 res[key] = valid_subitems
+        return subitems
 
-    def _set_record_id_from_domain(self, res, ident_keys, domain):
-        record = self.with_context(active_test=False).search(domain)
+    @api.model
+    def _get_full_xmlid(self, xmlid):
+        if "." in xmlid:
+            return xmlid
+        # same default module as the load
+        return "{}.{}".format(self._context.get("module", "__import__"), xmlid)
+
+    @api.model
+    def _get_record_id_from_xmlid(self, xmlid):
+        xmlids = self._context.get("pattern_config", {}).get("xmlids")
+        if xmlids is None:
+            return self.env.ref(xmlid).id
+        return xmlids.get((self._name, self._get_full_xmlid(xmlid)))
+
+    @api.model
+    def _collect_xmlids(self, res, xmlids):
+        """Collect by model the external ids of an item, of its one2many
+        lines and of its relational subfields (partner_id|id, ...)
+        @param xmlids: dict model -> set of xmlid"""
+        if isinstance(res.get("id"), str):
+            xmlids[self._name].add(self._get_full_xmlid(res["id"]))
+        for key, value in res.items():
+            field = self._fields.get(key)
+            if not field or not value or not field.relational:
+                continue
+            comodel = self.env[field.comodel_name]
+            for subitem in value if isinstance(value, list) else [value]:
+                if not isinstance(subitem, dict):
+                    continue
+                elif field.type == "one2many":
+                    comodel._collect_xmlids(subitem, xmlids)
+                elif isinstance(subitem.get("id"), str):
+                    xmlids[comodel._name].add(comodel._get_full_xmlid(subitem["id"]))
+
+    @api.model
+    def _resolve_xmlids(self, items):
+        """Resolve all the external ids of the items with one query per model
+        @return: dict (model, xmlid) -> res_id of the existing records"""
+        xmlids = defaultdict(set)
+        for res in items:
+            self._collect_xmlids(res, xmlids)
+        result = {}
+        for model_name, model_xmlids in xmlids.items():
+            rows = self.env["ir.model.data"]._lookup_xmlids(
+                model_xmlids, self.env[model_name]
+            )
+            for _imd_id, module, name, model, res_id, _noupdate, r_id in rows:
+                # r_id is empty if the record referenced has been deleted
+                if model == model_name and r_id:
+                    result[(model, "{}.{}".format(module, name))] = res_id
+        return result
+
+    def _set_record_id(self, res, ident_keys, record):
         if len(record) > 1:
             raise ValidationError(
                 _("Too many {} found for the key/value : {}").format(
@@ -190,46 +546,209 @@ class Base(models.AbstractModel):
             for key in ident_keys:
                 res.pop(key)
 
-    def _post_process_key(self, res, domain=None, parent_do_not_exist=False):
-        """Process identifier key
+    def _set_record_id_from_domain(self, res, ident_keys, domain):
+        record = self.with_context(active_test=False).search(domain)
+        self._set_record_id(res, ident_keys, record)
+
+    def _is_batch_key_value(self, field, value):
+        """Return True if searching the value with "=" on the field gives
+        the same result as comparing it in python with the stored value"""
+        if not value or isinstance(value, bool) or not field.store:
+            return False
+        elif field.type in ("char", "text", "selection"):
+            return isinstance(value, str) and not field.translate
+        elif field.type == "integer":
+            return isinstance(value, int)
+        return False
+
+    def _get_batch_key_values(self, res, ident_keys):
+        """Return the list of (path, value) to match for the identifier keys
+        or None if they can not be resolved in batch"""
+        key_values = []
+        for key in ident_keys:
+            field_name = key.replace(IDENTIFIER_SUFFIX, "")
+            field = self._fields.get(field_name)
+            value = res[key]
+            if not field:
+                return None
+            elif isinstance(value, dict):
+                if field.type != "many2one":
+                    return None
+                comodel = self.env[field.comodel_name]
+                for subfield, subvalue in value.items():
+                    if subfield == ".id":
+                        subfield = "id"
+                    subfield_obj = comodel._fields.get(subfield)
+                    if not subfield_obj or not self._is_batch_key_value(
+                        subfield_obj, subvalue
+                    ):
+                        return None
+                    key_values.append(((field_name, subfield), subvalue))
+            elif self._is_batch_key_value(field, value):
+                key_values.append(((field_name,), value))
+            else:
+                return None
+        return key_values
+
+    def _get_batch_parent_field(self, domain):
+        """Return the many2one field restricting the search of the one2many
+        lines, False if there is no restriction, None if not supported"""
+        if not domain:
+            return False
+        if len(domain) == 1:
+            field_name, operator, _value = domain[0]
+            field = self._fields.get(field_name)
+            if operator == "=" and field and field.type == "many2one":
+                return field_name
+        return None
+
+    def _set_record_ids_from_keys(self, todo):
+        """Search the records matching the identifier keys with one query
+        for all the items sharing the same keys
+        @param todo: list of (res, ident_keys, domain, domain_key)"""
+        groups = defaultdict(list)
+        for res, ident_keys, domain, domain_key in todo:
+            key_values = self._get_batch_key_values(res, ident_keys)
+            parent_field = self._get_batch_parent_field(domain)
+            if key_values is None or parent_field is None:
+                full_domain = expression.AND([domain, domain_key])
+                self._set_record_id_from_domain(res, ident_keys, full_domain)
+            else:
+                paths = tuple(path for path, _value in key_values)
+                parent_id = domain[0][2] if parent_field else None
+                values = tuple(value for _path, value in key_values)
+                groups[(parent_field, paths)].append(
+                    (res, ident_keys, parent_id, values)
+                )
+
+        model = self.with_context(active_test=False)
+        for (parent_field, paths), items in groups.items():
+            search_domain = [
+                (".".join(path), "in", list({item[3][idx] for item in items}))
+                for idx, path in enumerate(paths)
+            ]
+            if parent_field:
+                parent_ids = list({item[2] for item in items})
+                search_domain.append((parent_field, "in", parent_ids))
+            records = defaultdict(model.browse)
+            for record in model.search(search_domain):
+                parent_id = record[parent_field].id if parent_field else None
+                values = []
+                for path in paths:
+                    value = record
+                    for name in path:
+                        value = value[name]
+                    values.append(value)
+                records[(parent_id, tuple(values))] |= record
+            for res, ident_keys, parent_id, values in items:
+                record = records.get((parent_id, values), model.browse())
+                self._set_record_id(res, ident_keys, record)
+
+    def _post_process_keys(self, items):
+        """Process identifier key of a list of items in batch
         - search existing record and inject id
         - remove #key for dict key
+        @param items: list of (res, domain, parent_do_not_exist)
+        the domain restrict the search (used for one2many lines)
         """
-        if domain is None:
-            domain = []
-        domain_key, ident_keys = self._get_domain_from_identifier_key(res)
-
-        if domain_key and not parent_do_not_exist:
-            full_domain = expression.AND([domain, domain_key])
-            self._set_record_id_from_domain(res, ident_keys, full_domain)
+        todo = []
+        items_ident_keys = []
+        for res, domain, parent_do_not_exist in items:
+            domain_key, ident_keys = self._get_domain_from_identifier_key(res)
+            if domain_key and not parent_do_not_exist:
+                todo.append((res, ident_keys, domain, domain_key))
+            items_ident_keys.append(ident_keys)
+        if todo:
+            self._set_record_ids_from_keys(todo)
+
+        subitems = defaultdict(list)
+        for res, _domain, parent_do_not_exist in items:
+            for comodel, subitem in self._post_process_o2m_fields(
+                res, parent_do_not_exist=parent_do_not_exist
+            ):
+                subitems[comodel].append(subitem)
+        for comodel, comodel_items in subitems.items():
+            self.env[comodel]._post_process_keys(comodel_items)
+
+        for (res, _domain, _parent), ident_keys in zip(items, items_ident_keys):
+            self._clean_identifier_key(res, ident_keys)
+        return [res for res, _domain, _parent in items]
 
-        self._post_process_o2m_fields(res, parent_do_not_exist=parent_do_not_exist)
-        self._clean_identifier_key(res, ident_keys)
+    def _post_process_key(self, res, domain=None, parent_do_not_exist=False):
+        """Process identifier key of one item, see _post_process_keys"""
+        self._post_process_keys([(res, domain or [], parent_do_not_exist)])
         return res
 
-    def _remove_commented_and_empty_columns(self, row):
-        for key in list(row.keys()):
-            if key is None:
-                row.pop(None)
-            elif key.startswith("#"):
-                row.pop(key)
-
-    def _strip_string(self, row):
-        for key in row:
-            if isinstance(row[key], str):
-                row[key] = row[key].strip()
+    @api.model
+    def _get_existing_dbids(self, items):
+        """Return the set of the database ids (.id) of the items that exist,
+        they are checked in one query instead of one per row"""
+        if self._fields["id"].type != "integer":
+            return None
+        dbids = set()
+        for res in items:
+            try:
+                dbids.add(int(res[".id"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+        if not dbids:
+            return set()
+        return set(
+            self.with_context(active_test=False).search([("id", "in", list(dbids))]).ids
+        )
+
+    def _resolve_row_keys_again(self, row, builders):
+        """Build the row again and resolve its identifier keys alone,
+        used for the rows not found before a record was created"""
+        res = self._post_process_key(builders[tuple(row)](row))
+        existing_dbids = self._context["pattern_config"]["existing_dbids"]
+        if ".id" in res and existing_dbids is not None:
+            existing_dbids.add(res[".id"])
+        return res
 
     @api.model
     def _extract_records(self, fields_, data, log=lambda a: None, limit=FLOAT_INF):
         pattern_config = self._context.get("pattern_config")
         if pattern_config:
+            rows = []
+            # the columns are analysed once for all the rows with the same keys
+            builders = {}
             for idx, row in data:
-                self._strip_string(row)
-                self._remove_commented_and_empty_columns(row)
-                if not any(row.values()):
-                    continue
+                keys = tuple(row)
+                if keys not in builders:
+                    builders[keys] = self._get_row_builder(keys)
+                res = builders[keys](row)
+                if res is not None:
+                    rows.append((idx, res))
+            pattern_config["xmlids"] = self._resolve_xmlids([res for _idx, res in rows])
+            keyed_idx = {
+                idx
+                for idx, res in rows
+                if any(key.endswith(IDENTIFIER_SUFFIX) for key in res)
+            }
+            # the identifier keys of the whole chunk are resolved together
+            self._post_process_keys([(res, [], False) for _idx, res in rows])
+            unresolved_idx = {
+                idx for idx, res in rows if idx in keyed_idx and ".id" not in res
+            }
+            nbr_load = pattern_config.get("nbr_load", 0)
+            # and the relational values are searched once for all the rows
+            self.env["ir.fields.converter"]._prefetch_db_id_for(
+                self, [res for _idx, res in rows]
+            )
+            pattern_config["existing_dbids"] = self._get_existing_dbids(
+                [res for _idx, res in rows]
+            )
+            # used to log the errors of the rows isolated by the bisection
+            pattern_config["log"] = log
 
-                yield self._pattern_format2json(row), {"rows": {"from": idx, "to": idx}}
+            rows_data = dict(data)
+            for idx, res in rows:
+                if idx in unresolved_idx and pattern_config.get("nbr_load") != nbr_load:
+                    # a flush triggered by a previous row may have created
+                    # the record matching the keys, search it again
+                    res = self._resolve_row_keys_again(rows_data[idx], builders)
+                yield res, {"rows": {"from": idx, "to": idx}}
 
                 # WARNING: complex code
                 # As we are in an generator the following code is executed
@@ -254,9 +773,12 @@ class Base(models.AbstractModel):
             # Note the log method is equal to messages.append
             # so log.__self__ return the messages list
             messages = log.__self__
-            if messages and messages[-1]["rows"] == info["rows"]:
+            if messages and messages[-1].get("rows") == info["rows"]:
                 # we have a message for this item so we skip it from conversion
                 # so the record will be not imported
                 continue
             else:
+                if self._context.get("pattern_config"):
+                    # the record will be added to the batch to load
+                    self._context["pattern_config"]["pending_load"] = True
                 yield dbid, xid, record, info
@@ -2,10 +2,96 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import fields, models
+import hashlib
+import os
+import tempfile
+from functools import partial
+
+from odoo import api, fields, models
+
+BLOCK_SIZE = 1024 * 1024
 
 
 class IrAttachment(models.Model):
     _inherit = "ir.attachment"
 
     pattern_file_ids = fields.One2many("pattern.file", "attachment_id", "Pattern File")
+
+    @api.model
+    def _store_file_from_stream(self, fileobj):
+        """Store the content of a binary file object without loading it
+        in memory (except for the storages other than the local filestore).
+        The checksum is computed on the fly while the file is copied in
+        the filestore.
+        @return: dict of values to write on the attachment, only raw for
+        the storages of other modules
+        """
+        if self._storage() != "file":
+            raw = fileobj.read()
+            if self._storage() != "db":
+                # storage of another module (object storage...),
+                # written with the native api
+                return {"raw": raw}
+            return {
+                "store_fname": None,
+                "db_datas": raw,
+                "file_size": len(raw),
+                "checksum": self._compute_checksum(raw),
+            }
+        filestore = self._filestore()
+        os.makedirs(filestore, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=filestore)
+        try:
+            checksum = hashlib.sha1()
+            file_size = 0
+            with os.fdopen(fd, "wb") as tmp_file:
+                for block in iter(partial(fileobj.read, BLOCK_SIZE), b""):
+                    checksum.update(block)
+                    file_size += len(block)
+                    tmp_file.write(block)
+            checksum = checksum.hexdigest()
+            fname = checksum[:2] + "/" + checksum
+            full_path = self._full_path(fname)
+            if os.path.isfile(full_path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.rename(tmp_path, full_path)
+                self._mark_for_gc(fname)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return {
+            "store_fname": fname,
+            "db_datas": None,
+            "file_size": file_size,
+            "checksum": checksum,
+        }
+
+    def _write_file_from_stream(self, fileobj):
+        """Set the content of the attachment from a binary file object.
+        Native write need the whole content in memory (and in base64)
+        so we directly update the storage columns"""
+        self.ensure_one()
+        self.check("write")
+        old_fname = self.store_fname
+        values = self._store_file_from_stream(fileobj)
+        if "raw" in values:
+            self.write(values)
+            return
+        self.flush()
+        self._cr.execute(
+            """
+            UPDATE ir_attachment
+            SET store_fname = %(store_fname)s,
+                db_datas = %(db_datas)s,
+                file_size = %(file_size)s,
+                checksum = %(checksum)s
+            WHERE id = %(id)s
+            """,
+            dict(values, id=self.id),
+        )
+        self.invalidate_cache(ids=self.ids)
+        if old_fname and old_fname != values["store_fname"]:
+            self._file_delete(old_fname)
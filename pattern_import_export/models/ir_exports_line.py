@@ -53,6 +53,36 @@ class IrExportsLine(models.Model):
         "Value should be >= 1",
     )
 
+    # the compiled plan of the patterns depends on the export lines
+    # (including the one of the sub-patterns)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self._clear_pattern_plan(records.export_id)
+        return records
+
+    def write(self, vals):
+        exports = self.export_id
+        res = super().write(vals)
+        self._clear_pattern_plan(exports | self.export_id)
+        return res
+
+    def unlink(self):
+        exports = self.export_id
+        res = super().unlink()
+        self._clear_pattern_plan(exports)
+        return res
+
+    @api.model
+    def _clear_pattern_plan(self, exports):
+        """Clear the cached plans only if the lines belong to a pattern,
+        the other exports do not use them"""
+        if exports and self.env["pattern.config"].sudo().search_count(
+            [("export_id", "in", exports.ids)]
+        ):
+            self.clear_caches()
+
     @api.model
     def _get_last_relation_field(self, model, path, level=1):
         if "/" not in path:
@@ -3,6 +3,7 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 import ast
+from collections import defaultdict
 
 from odoo import _, api, models
 from odoo.osv import expression
@@ -48,31 +49,119 @@ class IrFieldsConverter(models.AbstractModel):
                 [subfield] = fieldset
                 return subfield, []
 
+    @api.model
+    def _get_field_domain(self, field):
+        # Only list domain and server-side evaluable are supported
+        # as they can be apply on server-side
+        if isinstance(field.domain, list):
+            return field.domain
+        try:
+            return ast.literal_eval(field.domain)
+        except ValueError:
+            return []
+
+    @api.model
+    def _get_db_id_domain(self, field, subfield, value):
+        return expression.AND([self._get_field_domain(field), [(subfield, "=", value)]])
+
+    @api.model
+    def _collect_references(self, model, res, references):
+        """Collect the values of the relational subfields of an item
+        (partner_id|ref, tag_ids|1|name, ...) including one2many lines.
+        The references to the imported model are skipped as they can be
+        created by the import itself.
+        @param references: dict (field, subfield) -> set of values"""
+        imported_model = self.env.context.get("pattern_config", {}).get("model")
+        for key, value in res.items():
+            field = model._fields.get(key)
+            if not field or not value:
+                continue
+            if field.type == "one2many" and isinstance(value, list):
+                comodel = self.env[field.comodel_name]
+                for subitem in value:
+                    self._collect_references(comodel, subitem, references)
+            elif field.type in ("many2one", "many2many"):
+                if field.comodel_name == imported_model:
+                    continue
+                comodel = self.env[field.comodel_name]
+                subitems = value if isinstance(value, list) else [value]
+                for subitem in subitems:
+                    if not isinstance(subitem, dict) or len(subitem) != 1:
+                        continue
+                    [(subfield, subvalue)] = subitem.items()
+                    subfield_obj = comodel._fields.get(subfield)
+                    if (
+                        subfield not in (".id", "id")
+                        and subfield_obj
+                        and comodel._is_batch_key_value(subfield_obj, subvalue)
+                    ):
+                        references[(field, subfield)].add(subvalue)
+
+    @api.model
+    def _search_references(self, field, subfield, values):
+        """Search in one query all the records matching the values
+        @return: dict value -> list of ids"""
+        comodel = self.env[field.comodel_name].with_context(active_test=False)
+        domain = expression.AND(
+            [self._get_field_domain(field), [(subfield, "in", list(values))]]
+        )
+        result = {value: [] for value in values}
+        for item in comodel.search_read(domain, [subfield]):
+            if item[subfield] in result:
+                result[item[subfield]].append(item["id"])
+        return result
+
+    @api.model
+    def _prefetch_db_id_for(self, model, items):
+        """Resolve the relational subfield values of all the items with one
+        query per column and store the result in the cache of db_id_for"""
+        references = defaultdict(set)
+        for res in items:
+            self._collect_references(model, res, references)
+        cache = self.env.context["pattern_config"].setdefault("db_id_cache", {})
+        for (field, subfield), values in references.items():
+            for value, ids in self._search_references(field, subfield, values).items():
+                domain = self._get_db_id_domain(field, subfield, value)
+                cache[(field.comodel_name, repr(domain))] = tuple(ids)
+
+    @api.model
+    def _search_db_id(self, model, domain):
+        """Search the records matching the domain, during a pattern import
+        the result is cached as the same value is often used by many rows"""
+        pattern_config = self.env.context.get("pattern_config")
+        if pattern_config is None:
+            return self.env[model].search(domain)
+        cache = pattern_config.setdefault("db_id_cache", {})
+        key = (model, repr(domain))
+        if key not in cache:
+            cache[key] = tuple(self.env[model].search(domain).ids)
+        return self.env[model].browse(cache[key])
+
     @api.model
     def db_id_for(self, model, field, subfield, value):
         # We alway search on all record even inactive one as we may want to use
         # import feature to active record
         self = self.with_context(active_test=False)
+        xmlids = self.env.context.get("pattern_config", {}).get("xmlids")
+        if subfield == "id" and xmlids and isinstance(value, str) and "." in value:
+            # external ids of the chunk are resolved in batch before the load
+            res_id = xmlids.get((field._related_comodel_name, value))
+            if res_id:
+                return res_id, _("external id"), []
         if subfield in [".id", "id", None]:
             return super().db_id_for(model, field, subfield, value)
         else:
             if value:
-                # Only list domain and server-side evaluable are supported
-                # as they can be apply on server-side
-                if isinstance(field.domain, list):
-                    domain = field.domain
-                else:
-                    try:
-                        domain = ast.literal_eval(field.domain)
-                    except ValueError:
-                        domain = []
-                domain = expression.AND([domain, [(subfield, "=", value)]])
-                if (
-                    self.env.context.get("pattern_config", {}).get("model")
-                    == field._related_comodel_name
+                domain = self._get_db_id_domain(field, subfield, value)
+                comodel = field._related_comodel_name
+                pattern_config = self.env.context.get("pattern_config", {})
+                if pattern_config.get("model") == comodel and pattern_config.get(
+                    "pending_load"
                 ):
+                    # some records of the imported model are waiting to be
+                    # created, they may match the value
                     self._context["import_flush"]()
-                record = self.env[field._related_comodel_name].search(domain)
+                record = self._search_db_id(comodel, domain)
                 if len(record) > 1:
                     raise self._format_import_error(
                         ValueError,
@@ -68,8 +68,17 @@ def _convert_records(self, records, log=lambda a: None):
                         )
                     )
                 # End of code changed
-            # Code changed active_test=False
-            if not self.with_context(active_test=False).search([("id", "=", dbid)]):
+            # Code changed active_test=False and batch check
+            # the existing ids are checked in batch by _extract_records
+            # when the first record is read, so they are read here
+            existing_dbids = (self._context.get("pattern_config") or {}).get(
+                "existing_dbids"
+            )
+            if existing_dbids is not None:
+                exist = dbid in existing_dbids
+            else:
+                exist = self.with_context(active_test=False).search([("id", "=", dbid)])
+            if not exist:
                 # End of code changed
                 log(
                     dict(
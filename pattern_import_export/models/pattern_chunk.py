@@ -2,13 +2,15 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+import time
+
 from odoo import fields, models
 
 
 class PatternChunk(models.Model):
     _name = "pattern.chunk"
     _description = "Pattern Chunk"
-    _order = "start_idx"
+    _order = "wave, partition, start_idx"
     _rec_name = "start_idx"
 
     pattern_file_id = fields.Many2one(
@@ -16,13 +18,27 @@ class PatternChunk(models.Model):
     )
     start_idx = fields.Integer()
     stop_idx = fields.Integer()
-    data = fields.Serialized()
-    record_ids = fields.Serialized()
-    messages = fields.Serialized()
-    result_info = fields.Html()
+    wave = fields.Integer(
+        help="Chunks of a wave are processed after the chunks of the previous waves"
+    )
+    partition = fields.Integer(
+        help="Chunks of a partition are processed one after the other"
+    )
+    # the payload of the chunk is only read when needed, never prefetched
+    # with the state and the statistics
+    data = fields.Serialized(prefetch=False)
+    record_ids = fields.Serialized(prefetch=False)
+    messages = fields.Serialized(prefetch=False)
+    result_info = fields.Html(prefetch=False)
     nbr_error = fields.Integer()
     nbr_success = fields.Integer()
+    nbr_unchanged = fields.Integer(help="Number of records not written as unchanged")
     nbr_item = fields.Integer()
+    nbr_weight = fields.Integer(
+        help="Number of rows and of their one2many lines, used with the "
+        "duration to estimate the cost of a row"
+    )
+    duration = fields.Float(help="Duration of the import in seconds")
     state = fields.Selection(
         selection=[
             ("pending", "Pending"),
@@ -33,36 +49,38 @@ class PatternChunk(models.Model):
     )
 
     def run_import(self):
-        model = self.pattern_file_id.pattern_config_id.model_id.model
+        config = self.pattern_file_id.pattern_config_id
+        model = config.model_id.model
+        start = time.perf_counter()
         res = (
             self.with_context(
                 pattern_config={
                     "model": model,
                     "record_ids": [],
-                    "purge_one2many": self.pattern_file_id.pattern_config_id.purge_one2many,
+                    "purge_one2many": config.purge_one2many,
+                    "one2many_diff": config.one2many_diff,
+                    "skip_unchanged": config.skip_unchanged,
+                    "bisect_retry": config.bisect_retry,
+                    "header_paths": config._get_pattern_plan().import_paths,
                 }
             )
             .env[model]
             .load([], self.data)
         )
-        self.write(self._prepare_chunk_result(res))
-        config = self.pattern_file_id.pattern_config_id
-        priority = config.job_priority
-        if not config.process_multi:
-            next_chunk = self.get_next_chunk()
-            if next_chunk:
-                next_chunk.with_delay(priority=priority).run()
-            else:
-                self.with_delay(priority=5).check_last()
-        else:
-            self.with_delay(priority=5).check_last()
+        vals = self._prepare_chunk_result(res)
+        vals["duration"] = time.perf_counter() - start
+        self.write(vals)
 
     def run(self):
         """Process Import of Pattern Chunk"""
+        if self.state in ("done", "failed"):
+            # the job is run again after the result has been committed
+            # (e.g. retried by queue_job), do not import the rows twice
+            return "Chunk already processed"
         cr = self.env.cr
         try:
             self.state = "started"
-            cr.commit()  # pylint: disable=invalid-commit
+            self._commit()
             with cr.savepoint():
                 self.run_import()
         except Exception as e:
@@ -73,9 +91,34 @@ class PatternChunk(models.Model):
                     "state": "failed",
                 }
             )
-            self.with_delay().check_last()
+        self._close_chunk()
         return "OK"
 
+    def _commit(self):
+        """Commit the work done, except when the file is imported inline
+        in the transaction of the caller"""
+        if not self._context.get("pattern_import_inline"):
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _close_chunk(self):
+        """Decrement the number of remaining chunks of the file,
+        the chunk that processes the last one sets the import as done"""
+        pattern_file = self.pattern_file_id
+        next_chunk = self._get_next_partition_chunk()
+        if next_chunk:
+            # the next chunk of the partition takes the place of this one
+            # in the counter, no need to update it
+            config = self.pattern_file_id.pattern_config_id
+            next_chunk.with_delay(priority=config.job_priority).run()
+            self._commit()
+            return
+        # commit the result first, the counter is updated in its own
+        # transaction and nothing is read before so the next transaction
+        # sees the counter updated
+        self._commit()
+        if pattern_file._add_chunk_todo(-1) == 0:
+            pattern_file._process_next_wave()
+
     def _prepare_chunk_result(self, res):
         # TODO rework this part and add specific test case
         nbr_error = len(res["messages"])
@@ -100,21 +143,32 @@ class PatternChunk(models.Model):
             "result_info": result,
             "state": state,
             "nbr_success": nbr_success,
+            "nbr_unchanged": res.get("nbr_unchanged", 0),
             "nbr_error": nbr_error,
         }
 
-    def get_next_chunk(self):
+    def _get_next_partition_chunk(self):
+        config = self.pattern_file_id.pattern_config_id
+        if not (config.process_multi and config.partition_count) or (
+            self._context.get("pattern_import_inline")
+        ):
+            return self.browse()
         return self.search(
             [
                 ("pattern_file_id", "=", self.pattern_file_id.id),
                 ("state", "=", "pending"),
+                ("wave", "=", self.wave),
+                ("partition", "=", self.partition),
             ],
             limit=1,
         )
 
     def is_last_job(self):
-        return not self.pattern_file_id.chunk_ids.filtered(
-            lambda s: s.state in ("pending", "started")
+        return not self.search_count(
+            [
+                ("pattern_file_id", "=", self.pattern_file_id.id),
+                ("state", "in", ("pending", "started")),
+            ]
         )
 
     def check_last(self):
@@ -2,18 +2,41 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import ast
 import base64
+import json
+import tempfile
+from collections import namedtuple
 
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.osv import expression
 
 from .common import COLUMN_X2M_SEPARATOR, IDENTIFIER_SUFFIX
 
+# Compiled version of the pattern shared by the import and the export
+# - header / description_header: tuple of the column names
+# - output_headers: tuple of dict header:value for each header row of the file
+# - parser: jsonify parser (None if a line use a resolver)
+# - accessors: tuple of (header, key path in the jsonified data)
+# - import_paths: dict header: key path in the nested import data
+PatternPlan = namedtuple(
+    "PatternPlan",
+    [
+        "header",
+        "description_header",
+        "output_headers",
+        "parser",
+        "accessors",
+        "import_paths",
+    ],
+)
+
 
 class PatternConfig(models.Model):
     """
     Add selection options on field export_format
     To implements:
-    _export_with_record_FORMAT (should use an iterator)
+    _write_export_FORMAT (should use an iterator and write in the binary
+    file object received), the former _export_with_record_FORMAT returning
+    the content of the file is still supported
     _read_import_data_FORMAT (should return an iterator)
     """
 
@@ -37,6 +60,22 @@ class PatternConfig(models.Model):
             "record that are not present in you file"
         )
     )
+    one2many_diff = fields.Boolean(
+        string="Update One2many In Place",
+        help=(
+            "Only used with the purge of One2many. Instead of removing all the\n"
+            "lines and linking again the ones of the file, the existing lines\n"
+            "are updated only if changed and only the lines missing in the\n"
+            "file are removed."
+        ),
+    )
+    skip_unchanged = fields.Boolean(
+        help=(
+            "When updating existing records, compare the values of the file\n"
+            "with the current values and only write the fields that changed.\n"
+            "Records without any change are not written at all."
+        )
+    )
     pattern_file = fields.Binary(string="Pattern file", readonly=True)
     pattern_file_name = fields.Char(readonly=True)
     pattern_last_generation_date = fields.Datetime(
@@ -44,12 +83,81 @@ class PatternConfig(models.Model):
     )
     export_format = fields.Selection(selection=[("json", "Json")])
     chunk_size = fields.Integer(default=500, help="Define the size of the chunk")
+    chunk_target_duration = fields.Integer(
+        string="Chunk Target Duration (s)",
+        help=(
+            "When set, the size of the chunks is adapted so each chunk is "
+            "imported in about this number of seconds, from the cost of the "
+            "rows and of their one2many lines measured on the previous "
+            "imports of this pattern. The chunk size is used until there are "
+            "statistics."
+        ),
+    )
+    chunk_byte_budget = fields.Integer(
+        string="Chunk Max Size (bytes)",
+        help=(
+            "When set, a chunk is closed when the size of its rows reaches "
+            "this number of bytes, the chunk size is not used anymore."
+        ),
+    )
+    export_batch_size = fields.Integer(
+        default=1000,
+        help=(
+            "Number of records read together when exporting.\n"
+            "All the fields of the pattern (including sub-patterns) are "
+            "prefetched in bulk for each batch"
+        ),
+    )
     count_pattern_file_failed = fields.Integer(compute="_compute_pattern_file_counts")
     count_pattern_file_pending = fields.Integer(compute="_compute_pattern_file_counts")
     count_pattern_file_done = fields.Integer(compute="_compute_pattern_file_counts")
     pattern_file_ids = fields.One2many("pattern.file", "pattern_config_id")
     process_multi = fields.Boolean()
+    import_waves = fields.Boolean(
+        string="Import In Dependency Waves",
+        help=(
+            "Only used with multi process. Rows referencing other rows of the "
+            "file (parent_id|ref, ...) are imported in a later wave than the "
+            "rows they reference. The chunks of a wave run in parallel, the "
+            "next wave starts when the previous one is done."
+        ),
+    )
+    split_commit_chunk = fields.Integer(
+        string="Commit Split Every N Chunks",
+        help=(
+            "Only used with multi process. When set, the chunks are committed "
+            "every N chunks while splitting the file so they can be imported "
+            "before the end of the split. 0 means one commit at the end. "
+            "Not used when importing in waves or in partitions."
+        ),
+    )
+    partition_count = fields.Integer(
+        string="Partitions",
+        help=(
+            "Only used with multi process. When set, the rows are dispatched "
+            "in this number of partitions from a hash of their identifying "
+            "columns (id, .id, #key) so the rows of a same record are in the "
+            "same partition. The partitions run in parallel, the chunks of a "
+            "partition one after the other. 0 means no partition."
+        ),
+    )
     job_priority = fields.Integer(default=20)
+    inline_import_max_row = fields.Integer(
+        string="Inline Import Threshold",
+        help=(
+            "Files with less rows than this number are imported directly when "
+            "launched, in the current transaction and without any job. "
+            "0 means the files are always imported with jobs."
+        ),
+    )
+    bisect_retry = fields.Boolean(
+        string="Bisect Failed Chunks",
+        help=(
+            "When a chunk fails, load each half of it in its own savepoint and "
+            "only split again the halves that fail, instead of loading the "
+            "rows one by one. Faster when only a few rows are wrong."
+        ),
+    )
 
     # we redefine previous onchanges since delegation inheritance breaks
     # onchanges on ir.exports
@@ -67,13 +175,36 @@ class PatternConfig(models.Model):
             s.export_fields = False
 
     def _compute_pattern_file_counts(self):
+        counts = {
+            (item["pattern_config_id"][0], item["state"]): item["__count"]
+            for item in self.env["pattern.file"].read_group(
+                [("pattern_config_id", "in", self.ids)],
+                ["pattern_config_id", "state"],
+                ["pattern_config_id", "state"],
+                lazy=False,
+            )
+        }
         for rec in self:
             for state in ("failed", "pending", "done"):
                 field_name = "count_pattern_file_" + state
-                count = len(
-                    rec.pattern_file_ids.filtered(lambda r: r.state == state).ids
-                )
-                setattr(rec, field_name, count)
+                setattr(rec, field_name, counts.get((rec.id, state), 0))
+
+    def _get_row_cost(self):
+        """Return the mean duration in seconds to import a row or a
+        one2many line, from the chunks imported with this pattern"""
+        stats = self.env["pattern.chunk"].read_group(
+            [
+                ("pattern_file_id.pattern_config_id", "=", self.id),
+                ("state", "=", "done"),
+                ("duration", ">", 0),
+                ("nbr_weight", ">", 0),
+            ],
+            ["duration", "nbr_weight"],
+            [],
+        )
+        if not stats or not stats[0]["nbr_weight"]:
+            return 0
+        return stats[0]["duration"] / stats[0]["nbr_weight"]
 
     def _open_pattern_file(self, domain=None):
         if domain is None:
@@ -107,16 +238,80 @@ class PatternConfig(models.Model):
         else:
             return 1
 
+    def write(self, vals):
+        res = super().write(vals)
+        if "header_format" in vals:
+            self.clear_caches()
+        return res
+
+    @tools.ormcache("self.id", "self.env.lang")
+    def _get_pattern_plan(self):
+        """Compile the export lines (and sub-patterns) of the pattern.
+        The plan is cached in the registry and invalidated when the export
+        lines or the header format are modified.
+        Returned value is shared, it must never be modified.
+        @return: PatternPlan
+        """
+        self.ensure_one()
+        header = tuple(self.export_fields._get_header())
+        description_header = tuple(self.export_fields._get_header(use_description=True))
+        output_headers = []
+        if self.header_format == "description_and_tech":
+            output_headers.append(dict(zip(header, description_header)))
+        output_headers.append(dict(zip(header, header)))
+        if self._get_all_export_fields().resolver_id:
+            # resolvers are records, they can not be kept in the registry cache
+            parser = None
+        else:
+            parser = self.export_fields._get_json_parser_for_pattern()
+        return PatternPlan(
+            header=header,
+            description_header=description_header,
+            output_headers=tuple(output_headers),
+            parser=parser,
+            accessors=tuple((key, self._get_export_key_path(key)) for key in header),
+            import_paths={key: self._get_import_key_path(key) for key in header},
+        )
+
+    def _get_all_export_fields(self):
+        export_fields = self.export_fields
+        for sub_pattern in export_fields.sub_pattern_config_id:
+            export_fields |= sub_pattern._get_all_export_fields()
+        return export_fields
+
+    @api.model
+    def _get_export_key_path(self, header):
+        """Return the path of the header value in the jsonified data"""
+        path = []
+        for key in header.split(COLUMN_X2M_SEPARATOR):
+            if key.isdigit():
+                key = int(key) - 1
+            elif IDENTIFIER_SUFFIX in key:
+                key = key.replace(IDENTIFIER_SUFFIX, "")
+            if key == ".id":
+                key = "id"
+            path.append(key)
+        return tuple(path)
+
+    @api.model
+    def _get_import_key_path(self, header):
+        """Return the path of the header value in the nested import data"""
+        return tuple(
+            int(key) if key.isdigit() else key
+            for key in header.split(COLUMN_X2M_SEPARATOR)
+        )
+
+    def _get_json_parser(self):
+        self.ensure_one()
+        parser = self._get_pattern_plan().parser
+        if parser is None:
+            parser = self.export_fields._get_json_parser_for_pattern()
+        return parser
+
     def _get_output_headers(self):
         """Return one or multiheader with key:value"""
-        tech_header = self._get_header()
-        headers = []
-        if self.header_format == "description_and_tech":
-            headers.append(
-                dict(zip(tech_header, self._get_header(use_description=True)))
-            )
-        headers.append(dict(zip(tech_header, tech_header)))
-        return headers
+        self.ensure_one()
+        return [dict(headers) for headers in self._get_pattern_plan().output_headers]
 
     def _get_header(self, use_description=False):
         """
@@ -125,10 +320,11 @@ class PatternConfig(models.Model):
         @return: list of string
         """
         self.ensure_one()
-        header = []
-        for export_line in self.export_fields:
-            header.extend(export_line._get_header(use_description))
-        return header
+        plan = self._get_pattern_plan()
+        if use_description:
+            return list(plan.description_header)
+        else:
+            return list(plan.header)
 
     def generate_pattern(self):
         """
@@ -154,25 +350,57 @@ class PatternConfig(models.Model):
     def _get_data_to_export(self, records):
         """
         Iterator who built data dict record by record.
-        This function could be recursive in case of sub-pattern
+        Records are read by batch: all the fields of the parser
+        (including sub-patterns) are prefetched for the whole batch
+        before building the data of each record
         """
         self.ensure_one()
-        json_parser = self.export_fields._get_json_parser_for_pattern()
-        for record in records:
-            yield self._get_data_to_export_by_record(record, json_parser)
+        json_parser = self._get_json_parser()
+        for batch in self._split_records_in_batch(records):
+            prefetched = self._prefetch_export_fields(batch, json_parser["fields"])
+            for record in batch:
+                yield self._get_data_to_export_by_record(record, json_parser)
+            # free the memory used by the batch and its related records
+            for prefetched_records in [batch] + prefetched:
+                prefetched_records.invalidate_cache(ids=prefetched_records.ids)
+
+    def _split_records_in_batch(self, records):
+        batch_size = self.export_batch_size or len(records) or 1
+        for idx in range(0, len(records), batch_size):
+            batch = records[idx : idx + batch_size]
+            # restrict the prefetch to the batch, the ORM will then read
+            # each field for all the records of the batch in one query
+            yield batch.with_prefetch(batch._ids)
+
+    @api.model
+    def _prefetch_export_fields(self, records, parser):
+        """Read in bulk all the field paths of the parser.
+        The jsonify done after will only hit the cache
+        @param records: recordset
+        @param parser: list of field dict or tuple (field dict, sub-parser)
+        @return: list of the related recordsets read
+        """
+        prefetched = []
+        for item in parser:
+            if isinstance(item, tuple):
+                field_dict, subparser = item
+            else:
+                field_dict, subparser = item, None
+            name = field_dict["name"]
+            if name not in records._fields or name == "id":
+                continue
+            value = records.mapped(name)
+            if subparser and value:
+                prefetched.append(value)
+                prefetched += self._prefetch_export_fields(value, subparser)
+        return prefetched
 
     def json2pattern_format(self, data):
         res = {}
-        for header in self._get_header():
+        for header, path in self._get_pattern_plan().accessors:
             try:
                 val = data
-                for key in header.split(COLUMN_X2M_SEPARATOR):
-                    if key.isdigit():
-                        key = int(key) - 1
-                    elif IDENTIFIER_SUFFIX in key:
-                        key = key.replace(IDENTIFIER_SUFFIX, "")
-                    if key == ".id":
-                        key = "id"
+                for key in path:
                     val = val[key]
                     if val is None:
                         break
@@ -193,25 +421,52 @@ class PatternConfig(models.Model):
         data = record.jsonify(parser)[0]
         return self.json2pattern_format(data)
 
-    def _generate_with_records(self, records):
+    def _write_export_json(self, records, output):
+        self.ensure_one()
+        output.write(b"[")
+        for idx, data in enumerate(self._get_data_to_export(records)):
+            if idx:
+                output.write(b",")
+            output.write(json.dumps(data).encode("utf-8"))
+        output.write(b"]")
+
+    def _generate_files_with_records(self, records):
         """
-        Export given recordset
+        Export given recordset in temporary files
         @param records: recordset
-        @return: list of base64 encoded
+        @return: list of binary file object (positioned at the beginning)
         """
-        all_data = []
+        all_files = []
         for export in self:
-            target_function = "_export_with_record_{format}".format(
-                format=export.export_format or ""
+            export_format = export.export_format or ""
+            write_export = getattr(export, "_write_export_" + export_format, None)
+            legacy_export = getattr(
+                export, "_export_with_record_" + export_format, None
             )
-            if not export.export_format or not hasattr(export, target_function):
+            if not export_format or not (write_export or legacy_export):
                 msg = "The export with the format {format} doesn't exist!".format(
                     format=export.export_format or "Undefined"
                 )
                 raise NotImplementedError(msg)
-            export_data = getattr(export, target_function)(records)
-            if export_data:
-                all_data.append(base64.b64encode(export_data))
+            output = tempfile.TemporaryFile()
+            if write_export:
+                write_export(records, output)
+            else:
+                output.write(legacy_export(records) or b"")
+            output.seek(0)
+            all_files.append(output)
+        return all_files
+
+    def _generate_with_records(self, records):
+        """
+        Export given recordset
+        @param records: recordset
+        @return: list of base64 encoded
+        """
+        all_data = []
+        for output in self._generate_files_with_records(records):
+            with output:
+                all_data.append(base64.b64encode(output.read()))
         return all_data
 
     def _export_with_record(self, records):
@@ -221,34 +476,35 @@ class PatternConfig(models.Model):
         @return: ir.attachment recordset
         """
         pattern_file_exports = self.env["pattern.file"]
-        all_data = self._generate_with_records(records)
-        if all_data and self.env.context.get("export_as_attachment", True):
-            for export, attachment_data in zip(self, all_data):
-                pattern_file_exports |= export._create_pattern_file_export(
-                    attachment_data
-                )
+        all_files = self._generate_files_with_records(records)
+        for export, output in zip(self, all_files):
+            with output:
+                if self.env.context.get("export_as_attachment", True):
+                    pattern_file_exports |= export._create_pattern_file_export(output)
         return pattern_file_exports
 
-    def _create_pattern_file_export(self, attachment_datas):
+    def _create_pattern_file_export(self, output):
         """
-        Attach given parameter (b64 encoded) to the current export.
-        @param attachment_datas: base64 encoded data
+        Attach given file to the current export.
+        The file is copied directly in the attachment storage
+        @param output: binary file object
         @return: ir.attachment recordset
         """
         self.ensure_one()
         name = "{name}.{format}".format(name=self.name, format=self.export_format)
-        return self.env["pattern.file"].create(
+        pattern_file = self.env["pattern.file"].create(
             {
                 "name": name,
                 "type": "binary",
                 "res_id": self.id,
                 "res_model": "pattern.config",
-                "datas": attachment_datas,
                 "kind": "export",
                 "state": "done",
                 "pattern_config_id": self.id,
             }
         )
+        pattern_file.attachment_id._write_file_from_stream(output)
+        return pattern_file
 
     def _add_update_tabs(self, result, tab_name, tab_vals):
         if tab_name in result["tabs"]:
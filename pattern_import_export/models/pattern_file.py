@@ -1,11 +1,80 @@
 #  Copyright (c) Akretion 2020
 #  License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html)
 
-import base64
+import io
 import json
+import os
+import re
+import threading
+import time
 import urllib.parse
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
 
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
+from odoo.exceptions import UserError
+
+from .common import COLUMN_X2M_SEPARATOR, IDENTIFIER_SUFFIX
+
+JSON_BLOCK_SIZE = 64 * 1024
+# number of chunks created in one call to create
+CHUNK_CREATE_BATCH = 50
+# fields of the file written by the split with the chunk counter
+SPLIT_FIELDS = ("nbr_chunk_todo", "split_running", "state", "info")
+# part of the time limit of the worker used by run_chunks before
+# enqueuing a new job
+RUN_CHUNKS_TIME_RATIO = 0.8
+WHITESPACE = re.compile(r"\s*")
+
+
+def compute_waves(refs, idents):
+    """Return the wave of each row referencing another row of the file
+    @param refs: dict idx -> list of (subfield, value) referenced by the row
+    @param idents: dict (subfield, value) -> list of idx identified by it
+    @return: dict idx -> wave, for the rows that are not in the first wave
+    """
+    deps = {}
+    for idx, row_refs in refs.items():
+        parents = {
+            parent_idx
+            for ref in row_refs
+            for parent_idx in idents.get(ref, [])
+            if parent_idx != idx
+        }
+        if parents:
+            deps[idx] = parents
+
+    # depth first search, the references in cycle are ignored
+    waves = {}
+    for start in deps:
+        stack = [start]
+        path = {start}
+        while stack:
+            idx = stack[-1]
+            if idx in waves:
+                stack.pop()
+                path.discard(idx)
+                continue
+            child = next(
+                (
+                    parent
+                    for parent in deps.get(idx, [])
+                    if parent not in waves and parent not in path
+                ),
+                None,
+            )
+            if child is not None:
+                stack.append(child)
+                path.add(child)
+                continue
+            stack.pop()
+            path.discard(idx)
+            waves[idx] = max(
+                (waves[parent] + 1 for parent in deps.get(idx, []) if parent in waves),
+                default=0,
+            )
+    return {idx: wave for idx, wave in waves.items() if wave}
 
 
 class PatternFile(models.Model):
@@ -25,16 +94,50 @@ class PatternFile(models.Model):
     )
     nbr_error = fields.Integer(compute="_compute_stat")
     nbr_success = fields.Integer(compute="_compute_stat")
+    nbr_unchanged = fields.Integer(compute="_compute_stat")
     progress = fields.Float(compute="_compute_stat")
     chunk_ids = fields.One2many("pattern.chunk", "pattern_file_id", "Chunk")
     date_done = fields.Datetime()
+    nbr_chunk_todo = fields.Integer(
+        help="Number of chunks remaining to process, the split counts as one "
+        "until it's finished"
+    )
+    split_running = fields.Boolean(
+        help="Set while the file is split with intermediate commits"
+    )
+    origin_id = fields.Many2one(
+        "pattern.file",
+        string="Failed Rows Of",
+        readonly=True,
+        help="The file contains the failed rows of this file with their "
+        "original row number",
+    )
 
-    @api.depends("chunk_ids.nbr_error", "chunk_ids.nbr_success")
+    @api.depends(
+        "chunk_ids.nbr_error", "chunk_ids.nbr_success", "chunk_ids.nbr_unchanged"
+    )
     def _compute_stat(self):
+        # aggregate in SQL, the chunks and their payload are never loaded
+        stats = {
+            item["pattern_file_id"][0]: item
+            for item in self.env["pattern.chunk"].read_group(
+                [("pattern_file_id", "in", self.ids)],
+                [
+                    "pattern_file_id",
+                    "nbr_error",
+                    "nbr_success",
+                    "nbr_unchanged",
+                    "nbr_item",
+                ],
+                ["pattern_file_id"],
+            )
+        }
         for record in self:
-            record.nbr_error = sum(record.mapped("chunk_ids.nbr_error"))
-            record.nbr_success = sum(record.mapped("chunk_ids.nbr_success"))
-            todo = sum(record.mapped("chunk_ids.nbr_item"))
+            stat = stats.get(record.id, {})
+            record.nbr_error = stat.get("nbr_error") or 0
+            record.nbr_success = stat.get("nbr_success") or 0
+            record.nbr_unchanged = stat.get("nbr_unchanged") or 0
+            todo = stat.get("nbr_item")
             if todo:
                 record.progress = (record.nbr_error + record.nbr_success) * 100.0 / todo
             else:
@@ -114,22 +217,120 @@ class PatternFile(models.Model):
         link += "<a href=" + url + ">" + _("Download") + "</a>"
         return link
 
-    def _parse_data(self):
-        data = base64.b64decode(self.datas.decode("utf-8"))
-        target_function = "_parse_data_{format}".format(
-            format=self.pattern_config_id.export_format or ""
+    @contextmanager
+    def _open_datafile(self):
+        """Open the content of the attachment as a binary file object.
+        File stored in the local filestore are read directly from the disk,
+        the other storages are read with the native api"""
+        attachment = self.attachment_id
+        full_path = (
+            attachment.store_fname
+            and attachment._storage() == "file"
+            and attachment._full_path(attachment.store_fname)
         )
+        if full_path and os.path.isfile(full_path):
+            with open(full_path, "rb") as datafile:
+                yield datafile
+        else:
+            with io.BytesIO(attachment.raw or b"") as datafile:
+                yield datafile
+
+    def _parse_data(self):
+        if self.origin_id:
+            # file built by action_import_failed_rows, whatever the format
+            target_function = "_parse_data_failed_rows"
+        else:
+            target_function = "_parse_data_{format}".format(
+                format=self.pattern_config_id.export_format or ""
+            )
         if not hasattr(self, target_function):
             raise NotImplementedError()
-        return getattr(self, target_function)(data)
+        with self._open_datafile() as datafile:
+            yield from getattr(self, target_function)(datafile)
 
-    def _parse_data_json(self, data):
-        items = json.loads(data.decode("utf-8"))
-        for idx, item in enumerate(items):
+    def _parse_data_json(self, datafile):
+        for idx, item in enumerate(self._iter_json_list(datafile)):
             yield idx + 1, item
 
+    def _parse_data_failed_rows(self, datafile):
+        for idx, item in self._iter_json_list(datafile):
+            yield idx, item
+
+    @api.model
+    def _iter_json_list(self, datafile):
+        """Decode the json list contained in the binary file item by item,
+        the file is read by block so only the current items are in memory"""
+        decoder = json.JSONDecoder()
+        reader = io.TextIOWrapper(datafile, encoding="utf-8")
+        buf = ""
+        pos = 0
+        eof = False
+        # "[" the start of the list, "first" an item or the end of an empty
+        # list, "item" an item, "," a separator or the end of the list,
+        # "end" nothing but whitespace
+        expected = "["
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                char = buf[pos]
+                if expected == "[":
+                    if char != "[":
+                        raise ValueError(_("The json file must contain a list"))
+                    expected = "first"
+                    pos += 1
+                    continue
+                elif expected == "end":
+                    raise ValueError(
+                        _("Unexpected data after the end of the json list")
+                    )
+                elif char == "]":
+                    if expected == "item":
+                        raise ValueError(_("Trailing comma in the json list"))
+                    expected = "end"
+                    pos += 1
+                    continue
+                elif expected == ",":
+                    if char != ",":
+                        raise ValueError(
+                            _("Invalid character '{}' in the json file").format(char)
+                        )
+                    expected = "item"
+                    pos += 1
+                    continue
+                item, end = self._decode_json_item(decoder, buf, pos, eof)
+                if end is not None:
+                    yield item
+                    pos = end
+                    expected = ","
+                    continue
+            elif eof:
+                if expected == "end":
+                    return
+                raise ValueError(_("Unexpected end of the json file"))
+            # the buffer does not contain the end of the next value
+            block = reader.read(JSON_BLOCK_SIZE)
+            eof = not block
+            buf = buf[pos:] + block
+            pos = 0
+
+    @api.model
+    def _decode_json_item(self, decoder, buf, pos, eof):
+        """Return the item starting at pos and its end position,
+        (None, None) if the end of the item may be in the next block"""
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            return None, None
+        next_pos = WHITESPACE.match(buf, end).end()
+        if not eof and (next_pos == len(buf) or buf[next_pos] not in ",]"):
+            # a number can continue in the next block (12|3, 1e|5)
+            return None, None
+        return item, end
+
     def _prepare_chunk(self, start_idx, stop_idx, data):
-        return {
+        vals = {
             "start_idx": start_idx,
             "stop_idx": stop_idx,
             "data": data,
@@ -137,44 +338,588 @@ class PatternFile(models.Model):
             "state": "pending",
             "pattern_file_id": self.id,
         }
+        config = self.pattern_config_id
+        if config.chunk_target_duration > 0 or config.chunk_byte_budget > 0:
+            # the weight is only used to adapt the size of the chunks
+            vals["nbr_weight"] = sum(self._get_item_weight(item) for _idx, item in data)
+        return vals
+
+    @api.model
+    def _get_item_weight(self, item):
+        """Return the number of records imported by the row:
+        the row itself and its one2many lines (line_ids|1|name, ...)"""
+        lines = set()
+        for key, value in item.items():
+            if not key or value in (None, ""):
+                continue
+            parts = key.split(COLUMN_X2M_SEPARATOR)
+            for pos, part in enumerate(parts[1:-1], 1):
+                if part.isdigit():
+                    lines.add(tuple(parts[: pos + 1]))
+        return 1 + len(lines)
+
+    def _get_chunk_budget(self):
+        """Return the limits of the chunks in adaptive mode:
+        - max_weight: number of rows and one2many lines imported in the
+        target duration
+        - max_size: number of bytes of the rows
+        None if the chunk size should be used"""
+        config = self.pattern_config_id
+        max_weight = 0
+        if config.chunk_target_duration > 0:
+            cost = config._get_row_cost()
+            if cost:
+                max_weight = max(int(config.chunk_target_duration / cost), 1)
+        max_size = max(config.chunk_byte_budget, 0)
+        if not (max_weight or max_size):
+            return None
+        return {"max_weight": max_weight, "max_size": max_size}
+
+    def _add_to_budget(self, budget, item):
+        budget["weight"] = budget.get("weight", 0) + self._get_item_weight(item)
+        if budget["max_size"]:
+            budget["size"] = budget.get("size", 0) + len(json.dumps(item, default=str))
 
     def _should_create_chunk(self, items, next_item):
         """Customise this code if you want to add some additionnal
-        item after reaching the limit"""
-        return len(items) > self.pattern_config_id.chunk_size
+        item after reaching the limit
+        In adaptive mode the limits of _get_chunk_budget with the weight and
+        size of the items are in the context key pattern_chunk_budget"""
+        budget = self._context.get("pattern_chunk_budget")
+        if not budget:
+            return len(items) > self.pattern_config_id.chunk_size
+        if not items:
+            return False
+        return (
+            budget["max_weight"] and budget.get("weight", 0) >= budget["max_weight"]
+        ) or (budget["max_size"] and budget.get("size", 0) >= budget["max_size"])
+
+    def _get_row_partition(self, idx, row):
+        """Return the partition of the row from a hash of its identifying
+        columns, the rows without identifier are dispatched by index"""
+        nbr_partition = self.pattern_config_id.partition_count
+        if not (self.pattern_config_id.process_multi and nbr_partition > 0):
+            return 0
+        # the identifier keys can be on a many2one (country_id#key|code),
+        # they are sorted as the keys of the json rows can be in any order
+        idents = sorted(
+            (key, str(value).strip())
+            for key, value in row.items()
+            if key
+            and (
+                key in ("id", ".id")
+                or key.split(COLUMN_X2M_SEPARATOR)[0].endswith(IDENTIFIER_SUFFIX)
+            )
+            and value not in (None, False, "")
+        )
+        if not idents:
+            return idx % nbr_partition
+        # crc32 is used as the hash of str is not stable between processes
+        return zlib.crc32(repr(idents).encode("utf-8")) % nbr_partition
+
+    def _prepare_lane(self, start_idx, budget):
+        lane_budget = budget and dict(budget)
+        return {
+            "items": [],
+            "start_idx": start_idx,
+            "previous_idx": None,
+            "budget": lane_budget,
+            # the budget is given by the context to _should_create_chunk
+            "split": self.with_context(pattern_chunk_budget=lane_budget),
+        }
+
+    def _add_to_lane(self, lane, idx, item):
+        lane["items"].append((idx, item))
+        lane["previous_idx"] = idx
+        if lane["budget"]:
+            self._add_to_budget(lane["budget"], item)
+
+    def _prepare_lane_chunk(self, lane_key, lane):
+        vals = self._prepare_chunk(
+            lane["start_idx"], lane["previous_idx"], lane["items"]
+        )
+        vals["wave"], vals["partition"] = lane_key
+        return vals
+
+    def _get_chunks_to_enqueue(self, chunks):
+        """Return the chunks to process first: the chunks of the lowest
+        wave, only the first one of each partition if partitioned"""
+        chunks = chunks.filtered(lambda chunk: chunk.wave == chunks[:1].wave)
+        if not self.pattern_config_id.partition_count:
+            return chunks
+        todo = chunks.browse()
+        partitions = set()
+        for chunk in chunks:
+            if chunk.partition not in partitions:
+                partitions.add(chunk.partition)
+                todo |= chunk
+        return todo
+
+    def _enqueue_chunks(self, chunks):
+        # the counter is incremented before enqueuing the jobs
+        self._add_chunk_todo(len(chunks))
+        config = self.pattern_config_id
+        for chunk in chunks:
+            chunk.with_delay(priority=config.job_priority).run()
 
-    def _create_chunk(self, start_idx, stop_idx, data):
-        vals = self._prepare_chunk(start_idx, stop_idx, data)
-        chunk = self.env["pattern.chunk"].create(vals)
-        # we enqueue the chunk in case of multi process of if it's the first chunk
-        if self.pattern_config_id.process_multi or len(self.chunk_ids) == 1:
-            chunk.with_delay(priority=self.pattern_config_id.job_priority).run()
-        return chunk
+    def _create_chunks(self, vals_list):
+        """Create the chunks in batch, in case of multi process
+        the chunks are enqueued directly
+        @param vals_list: list of values from _prepare_chunk
+        @return: the created chunks"""
+        chunks = self.env["pattern.chunk"].create(vals_list)
+        config = self.pattern_config_id
+        if self._is_sequential():
+            # the chunks are imported one after the other by run_chunks
+            self._add_chunk_todo(len(chunks))
+        elif not config.partition_count:
+            # the chunks of the next waves are enqueued later
+            self._enqueue_chunks(chunks.filtered(lambda chunk: not chunk.wave))
+        # the chunks of the partitions are enqueued at the end of the split
+        # so the next chunk of a partition always exists when one is done
+        # the data are not needed anymore, free the memory
+        chunks.invalidate_cache(["data"], chunks.ids)
+        return chunks
+
+    def _is_sequential(self):
+        """The chunks are imported one after the other without multi process
+        or when the file is imported inline"""
+        return not self.pattern_config_id.process_multi or self._context.get(
+            "pattern_import_inline"
+        )
+
+    def _enqueue_first_chunk(self, chunk):
+        """In sequential mode one job imports the chunks one after the other,
+        starting with the first one"""
+        if not chunk or not self._is_sequential():
+            return
+        if self._context.get("pattern_import_inline"):
+            self.run_chunks()
+        else:
+            self.with_delay(priority=self.pattern_config_id.job_priority).run_chunks()
+
+    def _should_import_inline(self):
+        """Return True if the file has less rows than the inline threshold
+        of the pattern"""
+        threshold = self.pattern_config_id.inline_import_max_row
+        if threshold <= 0:
+            return False
+        try:
+            for nbr_row, _row in enumerate(self._parse_data(), 1):
+                if nbr_row >= threshold:
+                    return False
+        except Exception:
+            # the split job will report the error
+            return False
+        return True
+
+    def launch_import(self):
+        """Import the file in the current transaction if it is small enough,
+        else enqueue the job splitting it in chunks"""
+        if self._should_import_inline():
+            self.with_context(pattern_import_inline=True).split_in_chunk()
+        else:
+            self.with_delay(
+                priority=self.pattern_config_id.job_priority
+            ).split_in_chunk()
+
+    @api.model
+    def _get_run_chunks_time_limit(self):
+        """Return the time in seconds a run_chunks job can use,
+        0 if the time of the worker is not limited"""
+        limit = tools.config.get("limit_time_real") or 0
+        return max(limit, 0) * RUN_CHUNKS_TIME_RATIO
+
+    def run_chunks(self):
+        """Import the pending chunks in the order of the file, each chunk
+        is committed. When the time limit of the worker is near, the job
+        enqueues a new one to import the remaining chunks"""
+        if self._context.get("pattern_import_inline"):
+            time_limit = 0
+        else:
+            time_limit = self._get_run_chunks_time_limit()
+        # only one job imports the chunks of the file, a chunk still started
+        # has been interrupted (worker killed...) and is imported again
+        self.chunk_ids.filtered(lambda chunk: chunk.state == "started").write(
+            {"state": "pending"}
+        )
+        start = time.monotonic()
+        max_duration = 0
+        while True:
+            chunk = self.env["pattern.chunk"].search(
+                [("pattern_file_id", "=", self.id), ("state", "=", "pending")],
+                limit=1,
+            )
+            if not chunk:
+                return "OK"
+            elapsed = time.monotonic() - start
+            if time_limit and max_duration and elapsed + max_duration > time_limit:
+                self.with_delay(
+                    priority=self.pattern_config_id.job_priority
+                ).run_chunks()
+                return "There is still some pending chunk"
+            chunk.run()
+            max_duration = max(max_duration, time.monotonic() - start - elapsed)
+
+    @contextmanager
+    def _chunk_todo_cursor(self):
+        """Cursor used to update the number of remaining chunks.
+        The counter is updated by the split and by all the chunks, so it is
+        updated in its own transaction, committed at once, with the READ
+        COMMITTED isolation: a concurrent update is waited and the row is
+        read again instead of failing with a serialization error.
+        In tests and inline imports the current transaction is used as the
+        file may not be committed yet"""
+        if self._context.get("pattern_import_inline") or getattr(
+            threading.current_thread(), "testing", False
+        ):
+            self.flush(["nbr_chunk_todo", "split_running"], self)
+            yield self.env.cr
+        else:
+            with self.pool.cursor() as cr:
+                if self.pool.test_cr is None:
+                    # a registry in test mode gives a cursor sharing the
+                    # transaction of the test
+                    cr.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+                yield cr
+
+    def _add_chunk_todo(self, delta, vals=None):
+        """Add delta to the number of remaining chunks in one atomic query
+        @param delta: the number of chunks to add (negative to remove)
+        @param vals: other values of the split written in the same query
+        (nbr_chunk_todo, split_running, state, info), the transaction of the
+        split never updates the file row updated by the running chunks
+        @return: the new number of remaining chunks"""
+        vals = dict(vals or {})
+        assert set(vals) <= set(SPLIT_FIELDS), "Only the split fields can be written"
+        names = list(vals)
+        params = [vals[name] for name in names]
+        assignments = ["{} = %s".format(name) for name in names]
+        if "nbr_chunk_todo" not in vals:
+            assignments.append("nbr_chunk_todo = COALESCE(nbr_chunk_todo, 0) + %s")
+            params.append(delta)
+        with self._chunk_todo_cursor() as cr:
+            cr.execute(
+                "UPDATE pattern_file SET {} WHERE id = %s "
+                "RETURNING nbr_chunk_todo".format(", ".join(assignments)),
+                params + [self.id],
+            )
+            vals["nbr_chunk_todo"] = cr.fetchone()[0]
+        # the transaction of the caller may not see the update yet
+        # so the cache is set with the written values
+        for name, value in vals.items():
+            field = self._fields[name]
+            self.env.cache.set(self, field, field.convert_to_cache(value, self))
+        if vals.get("state"):
+            self._notify_user()
+        return vals["nbr_chunk_todo"]
+
+    def _reset_chunk_todo(self):
+        """Count again the remaining chunks when an interrupted split is
+        resumed: the increments of the chunks created after its last commit
+        have been committed by the counter cursor but the chunks have been
+        rolled back. The split counts as one chunk.
+        @return: the new number of remaining chunks"""
+        self.env["pattern.chunk"].flush(["pattern_file_id", "state"])
+        with self._chunk_todo_cursor() as cr:
+            cr.execute(
+                """
+                UPDATE pattern_file SET nbr_chunk_todo = 1 + (
+                    SELECT count(*) FROM pattern_chunk
+                    WHERE pattern_file_id = %(id)s
+                    AND state IN ('pending', 'started')
+                )
+                WHERE id = %(id)s
+                RETURNING nbr_chunk_todo
+                """,
+                {"id": self.id},
+            )
+            nbr_chunk_todo = cr.fetchone()[0]
+        field = self._fields["nbr_chunk_todo"]
+        self.env.cache.set(self, field, field.convert_to_cache(nbr_chunk_todo, self))
+        return nbr_chunk_todo
+
+    def _commit(self):
+        """Commit the work done, except when the file is imported inline
+        in the transaction of the caller"""
+        if not self._context.get("pattern_import_inline"):
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _process_next_wave(self):
+        """Called when all the enqueued chunks are processed,
+        enqueue the chunks of the next wave or set the import as done"""
+        chunks = self.env["pattern.chunk"].search(
+            [("pattern_file_id", "=", self.id), ("state", "=", "pending")]
+        )
+        if chunks:
+            self._enqueue_chunks(self._get_chunks_to_enqueue(chunks))
+        else:
+            self.set_import_done()
+
+    @api.model
+    def _get_wave_column(self, model, key):
+        """Return how a column is used to compute the dependencies
+        - ("ident", subfield) for the columns identifying the row
+        (id, ref#key, name, ...)
+        - ("ref", subfield) for the columns referencing a record of the
+        imported model (parent_id|ref, category_ids|1|name, ...), the
+        one2many lines only reference a record when they have an identifier
+        key (child_ids|1|ref#key), the other lines are always created
+        - None for the others"""
+        if key is None or key.startswith("#"):
+            return None
+        parts = key.split("|")
+        name = parts[0].replace(IDENTIFIER_SUFFIX, "")
+        if len(parts) == 1:
+            return ("ident", name)
+        field = model._fields.get(name)
+        if (
+            not field
+            or field.comodel_name != model._name
+            or len(parts) > 3
+            or (len(parts) == 3 and not parts[1].isdigit())
+            or parts[-1] == ".id"
+        ):
+            return None
+        if field.type == "one2many":
+            if len(parts) != 3 or not parts[-1].endswith(IDENTIFIER_SUFFIX):
+                return None
+        elif field.type not in ("many2one", "many2many"):
+            return None
+        return ("ref", parts[-1].replace(IDENTIFIER_SUFFIX, ""))
+
+    def _get_row_waves(self):
+        """Read the file a first time to build the dependencies between the
+        rows from the columns referencing the imported model. A row is
+        imported in the wave following the waves of the rows it references.
+        @return: dict idx -> wave, for the rows that are not in the first wave
+        """
+        config = self.pattern_config_id
+        if not (config.process_multi and config.import_waves):
+            return {}
+        model = self.env[config.model_id.model]
+        columns = {}
+        ref_subfields = set()
+        idents = defaultdict(list)
+        refs = defaultdict(list)
+        for idx, row in self._parse_data():
+            for key in row:
+                if key not in columns:
+                    columns[key] = self._get_wave_column(model, key)
+                    if columns[key] and columns[key][0] == "ref":
+                        ref_subfields.add(columns[key][1])
+            for key, value in row.items():
+                if isinstance(value, str):
+                    value = value.strip()
+                if not value or not columns[key]:
+                    continue
+                kind, subfield = columns[key]
+                if kind == "ref":
+                    refs[idx].append((subfield, value))
+                else:
+                    # the rows may not have the same columns (json), a row
+                    # can be referenced by a column found in a later row
+                    idents[(subfield, value)].append(idx)
+        idents = {
+            ident: rows for ident, rows in idents.items() if ident[0] in ref_subfields
+        }
+        return compute_waves(refs, idents)
+
+    def _get_split_commit_chunk(self, waves):
+        """Return the number of chunks to create between two commits
+        of the split, 0 if the split is done in one transaction"""
+        config = self.pattern_config_id
+        # the rows of the waves and partitions are not in the order of the
+        # file so an interrupted split can not be resumed
+        if not self._is_sequential() and not waves and not config.partition_count:
+            return max(config.split_commit_chunk, 0)
+        return 0
 
     def split_in_chunk(self):
         """Split Pattern File into Pattern Chunk"""
-        # purge chunk in case of retring a job
-        self.chunk_ids.unlink()
+        cr = self.env.cr
+        resume_idx = 0
+        resume = self.split_running and self.chunk_ids
+        if resume:
+            # a previous split has been interrupted after committing some
+            # chunks, they may be already imported so we continue after them
+            resume_idx = max(self.chunk_ids.mapped("stop_idx"))
+        else:
+            # purge chunk in case of retring a job
+            self.chunk_ids.unlink()
+        try:
+            waves = self._get_row_waves()
+        except Exception as e:
+            self._add_chunk_todo(
+                0, {"state": "failed", "info": _("Failed to create the chunk: %s") % e}
+            )
+            return True
+        commit_chunk = self._get_split_commit_chunk(waves)
+        if resume:
+            self._reset_chunk_todo()
+        else:
+            # the split count as a chunk until the end, so the import
+            # can not be set as done before all chunks are created
+            self._add_chunk_todo(
+                0, {"nbr_chunk_todo": 1, "split_running": bool(commit_chunk)}
+            )
+        if commit_chunk:
+            cr.commit()  # pylint: disable=invalid-commit
+        batch_size = min(commit_chunk or CHUNK_CREATE_BATCH, CHUNK_CREATE_BATCH)
+        budget = self._get_chunk_budget()
         try:
-            items = []
-            start_idx = 1
-            previous_idx = None
+            # the rows of each wave and partition are split in chunks
+            # independently
+            lanes = {}
+            chunk_vals = []
+            first_chunk = self.env["pattern.chunk"].browse()
+            nbr_uncommitted = 0
             # idx is the index position in the original file
             # we can have empty line that can be skipped
             for idx, item in self._parse_data():
-                if self._should_create_chunk(items, item):
-                    self._create_chunk(start_idx, previous_idx, items)
-                    items = []
-                    start_idx = idx
-                items.append((idx, item))
-                previous_idx = idx
-            if items:
-                self._create_chunk(start_idx, idx, items)
+                if idx <= resume_idx:
+                    continue
+                lane_key = (waves.get(idx, 0), self._get_row_partition(idx, item))
+                lane = lanes.get(lane_key)
+                if not lane:
+                    lane = lanes[lane_key] = self._prepare_lane(
+                        idx if lanes else resume_idx + 1, budget
+                    )
+                if lane["split"]._should_create_chunk(lane["items"], item):
+                    chunk_vals.append(self._prepare_lane_chunk(lane_key, lane))
+                    lane.update(self._prepare_lane(idx, budget))
+                    if len(chunk_vals) >= batch_size:
+                        chunks = self._create_chunks(chunk_vals)
+                        first_chunk = first_chunk or chunks[:1]
+                        nbr_uncommitted += len(chunks)
+                        chunk_vals = []
+                        if commit_chunk and nbr_uncommitted >= commit_chunk:
+                            # the enqueued jobs become visible to the workers
+                            cr.commit()  # pylint: disable=invalid-commit
+                            nbr_uncommitted = 0
+                self._add_to_lane(lane, idx, item)
+            chunk_vals += [
+                self._prepare_lane_chunk(lane_key, lane)
+                for lane_key, lane in sorted(lanes.items())
+                if lane["items"]
+            ]
+            if chunk_vals:
+                chunks = self._create_chunks(chunk_vals)
+                first_chunk = first_chunk or chunks[:1]
+            self._enqueue_first_chunk(first_chunk)
+            # the chunks are committed before releasing the split count,
+            # the next transaction starts after the release
+            self._commit()
+            if self._add_chunk_todo(-1, {"split_running": False}) == 0:
+                self._process_next_wave()
         except Exception as e:
-            self.state = "failed"
-            self.info = _("Failed to create the chunk: %s") % e
+            self._add_chunk_todo(
+                0,
+                {
+                    "state": "failed",
+                    "info": _("Failed to create the chunk: %s") % e,
+                    "split_running": False,
+                },
+            )
+        return True
+
+    def check_references(self):
+        """Check, without importing anything, that the relational values
+        of the file (partner_id|ref, tag_ids|1|name, ...) exist"""
+        config = self.pattern_config_id
+        model = self.env[config.model_id.model].with_context(
+            pattern_config={
+                "model": config.model_id.model,
+                "header_paths": config._get_pattern_plan().import_paths,
+            }
+        )
+        converter = self.env["ir.fields.converter"].with_context(model.env.context)
+        references = defaultdict(set)
+        builders = {}
+        for _idx, row in self._parse_data():
+            keys = tuple(row)
+            if keys not in builders:
+                builders[keys] = model._get_row_builder(keys)
+            res = builders[keys](row)
+            if res is not None:
+                converter._collect_references(model, res, references)
+        missing = []
+        for (field, subfield), values in references.items():
+            result = converter._search_references(field, subfield, values)
+            values = sorted(str(value) for value, ids in result.items() if not ids)
+            if values:
+                missing.append(
+                    "{} / {}: {}".format(
+                        field.get_description(self.env)["string"],
+                        subfield,
+                        ", ".join(values),
+                    )
+                )
+        if missing:
+            self.info = _("Missing references:\n{}").format("\n".join(missing))
+        else:
+            self.info = _("All the references exist")
         return True
 
+    @api.model
+    def _get_chunk_failed_idx(self, chunk):
+        """Return the index of the rows of the chunk that were not imported
+        @return: set of index or None if no row has been imported"""
+        failed_idx = set()
+        interrupted = False
+        for message in chunk.messages or []:
+            if message.get("rows"):
+                rows = message["rows"]
+                failed_idx.update(range(rows["from"], rows["to"] + 1))
+            else:
+                # the load stopped after too many errors
+                interrupted = True
+        if not failed_idx:
+            # the whole chunk has been rollbacked
+            return None
+        if interrupted:
+            # the rows after the last error have not been loaded
+            failed_idx.update(idx for idx, _item in chunk.data if idx > max(failed_idx))
+        return failed_idx
+
+    def _get_failed_rows(self):
+        """Return the (index, row) of the rows that were not imported"""
+        rows = []
+        for chunk in self.chunk_ids.filtered(lambda c: c.state == "failed"):
+            failed_idx = self._get_chunk_failed_idx(chunk)
+            rows += [
+                (idx, item)
+                for idx, item in chunk.data
+                if failed_idx is None or idx in failed_idx
+            ]
+            # free the memory, the data are not needed anymore
+            chunk.invalidate_cache(["data"], chunk.ids)
+        return sorted(rows, key=lambda row: row[0])
+
+    def action_import_failed_rows(self):
+        """Import the failed rows in a new file, the rows keep
+        their number in the original file"""
+        self.ensure_one()
+        rows = self._get_failed_rows()
+        if not rows:
+            raise UserError(_("There is no failed row to import"))
+        pattern_file = self.create(
+            {
+                "name": "{}-failed.json".format(os.path.splitext(self.name or "")[0]),
+                "raw": json.dumps(rows).encode("utf-8"),
+                "kind": "import",
+                "pattern_config_id": self.pattern_config_id.id,
+                "origin_id": self.id,
+            }
+        )
+        pattern_file.launch_import()
+        return {
+            "type": "ir.actions.act_window",
+            "res_model": "pattern.file",
+            "res_id": pattern_file.id,
+            "view_mode": "form",
+        }
+
     def set_import_done(self):
         for record in self:
             if record.nbr_error:
@@ -2,6 +2,7 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+from unittest import mock
 
 from odoo.tests import SavepointCase
 
@@ -27,3 +28,46 @@ class TestConfig(SavepointCase):
         self.assertEqual(lines[0].level, 0)
         self.assertEqual(lines[1].level, 1)
         self.assertEqual(lines[2].level, 0)
+
+    def test_pattern_plan_cache(self):
+        config = self.env["pattern.config"].create(
+            {
+                "name": "Partner",
+                "resource": "res.partner",
+                "export_fields": [
+                    (0, 0, {"name": "name"}),
+                    (0, 0, {"name": "country_id/code", "is_key": True}),
+                ],
+            }
+        )
+        plan = config._get_pattern_plan()
+        self.assertIs(plan, config._get_pattern_plan())
+        self.assertEqual(plan.header, ("name", "country_id#key|code"))
+        self.assertEqual(
+            plan.accessors,
+            (("name", ("name",)), ("country_id#key|code", ("country_id", "code"))),
+        )
+        config.write({"export_fields": [(0, 0, {"name": "ref"})]})
+        self.assertEqual(config._get_header(), ["name", "country_id#key|code", "ref"])
+
+    def test_pattern_plan_cache_other_export(self):
+        export = self.env["ir.exports"].create(
+            {
+                "name": "Partner",
+                "resource": "res.partner",
+                "export_fields": [(0, 0, {"name": "name"})],
+            }
+        )
+        config = self.env["pattern.config"].create(
+            {
+                "name": "Partner",
+                "resource": "res.partner",
+                "export_fields": [(0, 0, {"name": "name"})],
+            }
+        )
+        ExportLine = type(self.env["ir.exports.line"])
+        with mock.patch.object(ExportLine, "clear_caches") as clear_caches:
+            export.export_fields.write({"name": "ref"})
+            clear_caches.assert_not_called()
+            config.export_fields.write({"name": "ref"})
+            self.assertTrue(clear_caches.called)
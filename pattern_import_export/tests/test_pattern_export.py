@@ -1,5 +1,10 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import base64
+import hashlib
+import json
+from unittest import mock
+
 from odoo.tests.common import SavepointCase
 
 from .common import PatternCommon
@@ -386,6 +391,50 @@ class PatternTestExport(PatternCommon, SavepointCase, PatternCaseExport):
     def _get_data(self, pattern_config, records):
         return pattern_config._get_data_to_export(records)
 
+    def test_get_data_to_export_by_batch(self):
+        expected_results = list(self._get_data(self.pattern_config_o2m, self.partners))
+        self.pattern_config_o2m.export_batch_size = 2
+        results = list(self._get_data(self.pattern_config_o2m, self.partners))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(expected_results, results)
+
+    def test_get_data_to_export_by_batch_invalidate(self):
+        country = self.env.ref("base.fr")
+        self.partners[0].country_id = country
+        self.pattern_config.export_batch_size = 1
+        self.partners.invalidate_cache()
+        country.invalidate_cache()
+        code = country._fields["code"]
+        data = self.pattern_config._get_data_to_export(self.partners)
+        next(data)
+        self.assertTrue(self.env.cache.contains(country, code))
+        list(data)
+        self.assertFalse(self.env.cache.contains(country, code))
+
+    def test_export_json_file(self):
+        self.pattern_config.export_format = "json"
+        pattern_file = self.pattern_config._export_with_record(self.partners)
+        raw = base64.b64decode(pattern_file.datas)
+        self.assertEqual(
+            json.loads(raw),
+            list(self._get_data(self.pattern_config, self.partners)),
+        )
+        self.assertEqual(pattern_file.file_size, len(raw))
+        self.assertEqual(pattern_file.checksum, hashlib.sha1(raw).hexdigest())
+
+    def test_export_legacy_format_hook(self):
+        self.pattern_config.export_format = "json"
+        PatternConfig = type(self.pattern_config)
+        with mock.patch.object(PatternConfig, "_write_export_json", None):
+            with mock.patch.object(
+                PatternConfig,
+                "_export_with_record_json",
+                lambda self, records: b"legacy",
+                create=True,
+            ):
+                data = self.pattern_config._generate_with_records(self.partners)
+        self.assertEqual(base64.b64decode(data[0]), b"legacy")
+
     def test_get_metadata(self):
         result = self.pattern_config_o2m._get_metadata()
         self.assertEqual(len(result["tabs"]), 2)
@@ -1,5 +1,9 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import io
+import json
+import threading
+from unittest import mock
 from uuid import uuid4
 
 from odoo.tests.common import SavepointCase
@@ -152,6 +156,24 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertIn(self.partner_2, self.partner_1.child_ids)
         self.assertIn(self.partner_3, self.partner_1.child_ids)
 
+    def test_create_o2m_with_new_external_id(self):
+        child_ref = str(uuid4())
+        self.partner_3.ref = child_ref
+        data = [
+            {
+                "id": "__import__.{}".format(uuid4().hex),
+                "name": str(uuid4()),
+                "child_ids|1|ref#key": child_ref,
+                "child_ids|1|name": str(uuid4()),
+            }
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        # the parent does not exist so the key of the child is not searched
+        self.assertEqual(len(records), 2)
+        self.assertNotIn(self.partner_3, records.child_ids)
+
     def test_update_o2m_m2m_with_external_id(self):
         """
         For this test, simulate the case of a complex update on existing record
@@ -255,6 +277,49 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertEqual(contact_1_name, contact_1.name)
         self.assertEqual(contact_2_name, contact_2.name)
 
+    def test_update_several_with_key(self):
+        self.partner_1.ref = str(uuid4())
+        self.partner_2.ref = str(uuid4())
+        data = [
+            {"ref#key": self.partner_1.ref, "street": "foo"},
+            {"ref#key": self.partner_2.ref, "street": "bar"},
+            {"ref#key": str(uuid4()), "name": "new"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(self.partner_1.street, "foo")
+        self.assertEqual(self.partner_2.street, "bar")
+        self.assertEqual(records.name, "new")
+
+    def test_update_with_ambiguous_key(self):
+        ref = str(uuid4())
+        self.partner_1.ref = ref
+        self.partner_2.ref = ref
+        data = [{"ref#key": ref, "street": "foo"}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertEqual(pattern_file.state, "failed")
+        self.assertIn("Too many", pattern_file.chunk_ids.result_info)
+
+    def test_update_with_key_created_by_flush(self):
+        parent_ref = str(uuid4())
+        child_ref = str(uuid4())
+        data = [
+            {"ref#key": parent_ref, "name": "parent"},
+            # the search of the parent creates the partner of the first row
+            {"ref#key": child_ref, "name": "child", "parent_id|ref": parent_ref},
+            {"ref#key": parent_ref, "name": "parent", "street": "foo"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        parent = self.env["res.partner"].search([("ref", "=", parent_ref)])
+        self.assertEqual(len(parent), 1)
+        self.assertEqual(parent.street, "foo")
+        child = records.filtered(lambda r: r.ref == child_ref)
+        self.assertEqual(child.parent_id, parent)
+
     def test_update_o2m_with_key_only_one_record(self):
         unique_name = str(uuid4())
         self.partner_1.ref = "o2m_main"
@@ -366,6 +431,14 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertIn(child_1, partner.child_ids)
         self.assertNotIn(child_2, partner.child_ids)
 
+    def test_o2m_update_with_purge_diff(self):
+        self.pattern_config.write({"purge_one2many": True, "one2many_diff": True})
+        partner, child_1, child_2 = self._helper_o2m_update()
+        self.assertEqual(len(partner.child_ids), 3)
+        self.assertIn(child_1, partner.child_ids)
+        self.assertTrue(child_1.name.endswith("-c1-renamed"))
+        self.assertNotIn(child_2, partner.child_ids)
+
     def test_o2m_update_without_purge(self):
         self.pattern_config.purge_one2many = False
         partner, child_1, child_2 = self._helper_o2m_update()
@@ -413,6 +486,61 @@ class TestPatternImport(PatternCommon, SavepointCase):
             pattern_file.chunk_ids.result_info,
         )
 
+    @mute_logger("odoo.sql_db")
+    def test_update_with_db_id(self):
+        unknown_id = self.env["res.partner"].search([], order="id desc", limit=1).id + 1
+        data = [
+            {".id": self.partner_1.id, "street": "foo"},
+            {".id": unknown_id, "street": "bar"},
+            {".id": self.partner_2.id, "street": "baz"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        id_operators = {("id", "in"), ("id", "=")}
+        Partner = type(self.env["res.partner"])
+        with mock.patch.object(
+            Partner, "search", autospec=True, side_effect=Partner.search
+        ) as search:
+            self.run_pattern_file(pattern_file)
+        # the existence of the ids is checked in one query for the chunk
+        id_leaves = [
+            leaf
+            for call in search.call_args_list
+            for leaf in call.args[1]
+            if isinstance(leaf, (list, tuple)) and tuple(leaf[:2]) in id_operators
+        ]
+        self.assertEqual(len(id_leaves), 1)
+        self.assertEqual(id_leaves[0][1], "in")
+        self.assertEqual(
+            sorted(id_leaves[0][2]),
+            sorted([self.partner_1.id, unknown_id, self.partner_2.id]),
+        )
+        self.assertEqual(self.partner_1.street, "foo")
+        self.assertEqual(self.partner_2.street, "baz")
+        self.assertEqual(pattern_file.nbr_error, 1)
+        self.assertIn(
+            "Unknown database identifier '{}'".format(unknown_id),
+            pattern_file.chunk_ids.result_info,
+        )
+
+    def test_update_skip_unchanged(self):
+        self.pattern_config.skip_unchanged = True
+        new_name = str(uuid4())
+        data = [
+            {".id": self.partner_1.id, "name": self.partner_1.name},
+            {".id": self.partner_2.id, "name": new_name},
+            {
+                ".id": self.partner_3.id,
+                "name": self.partner_3.name,
+                "country_id|code": self.partner_3.country_id.code,
+            },
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(self.partner_2.name, new_name)
+        self.assertEqual(pattern_file.nbr_success, 3)
+        self.assertEqual(pattern_file.nbr_unchanged, 2)
+
     def test_import_m2o_key(self):
         name = str(uuid4())
         ref = str(uuid4())
@@ -453,6 +581,58 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertEqual(len(partners), 2)
         self.assertEqual(partners[0], partners[1].parent_id)
 
+    def test_import_m2o_parents_several_children(self):
+        parent_name = str(uuid4())
+        data = [
+            {"name#key": parent_name},
+            {"name#key": str(uuid4()), "parent_id|name": parent_name},
+            {"name#key": str(uuid4()), "parent_id|name": parent_name},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(partners), 3)
+        self.assertEqual(partners[1:].parent_id, partners[0])
+
+    def test_import_m2o_subfield_lookup_cached(self):
+        data = [
+            {"name": str(uuid4()), "country_id|code": "BE"},
+            {"name": str(uuid4()), "country_id|code": "BE"},
+            {"name": str(uuid4()), "country_id|code": "US"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        country_model = type(self.env["res.country"])
+        with mock.patch.object(
+            country_model, "search", autospec=True, side_effect=country_model.search
+        ) as search:
+            partners = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(
+            partners.country_id, self.env.ref("base.be") | self.env.ref("base.us")
+        )
+        # all the codes are searched together
+        nbr_search = len(
+            [
+                call
+                for call in search.call_args_list
+                if any(leaf[0] == "code" for leaf in call[0][1])
+            ]
+        )
+        self.assertEqual(nbr_search, 1)
+
+    def test_check_references(self):
+        data = [
+            {"name": str(uuid4()), "country_id|code": "BE"},
+            {"name": str(uuid4()), "country_id|code": "XX"},
+            {"name": str(uuid4()), "category_id|1|name": "Unknown Tag"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        pattern_file.check_references()
+        self.assertIn("XX", pattern_file.info)
+        self.assertIn("Unknown Tag", pattern_file.info)
+        self.assertNotIn("BE", pattern_file.info)
+        self.assertFalse(pattern_file.chunk_ids)
+
     def test_update_m2m_with_a_lot_of_item(self):
         unique_name = str(uuid4())
         data = {"name": unique_name}
@@ -465,6 +645,17 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertEqual(len(partner), 1)
         self.assertEqual(len(partner.category_id), 14)
 
+    @mute_logger("odoo.sql_db")
+    def test_pattern_file_statistics(self):
+        data = [{"name": "foo"}, {"name": ""}, {"name": "bar"}]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertEqual(pattern_file.nbr_success, 2)
+        self.assertEqual(pattern_file.nbr_error, 1)
+        self.assertEqual(pattern_file.progress, 100)
+        self.pattern_config.invalidate_cache()
+        self.assertEqual(self.pattern_config.count_pattern_file_failed, 1)
+
     @mute_logger("odoo.sql_db")
     def test_partial_import(self):
         data = [
@@ -493,3 +684,454 @@ class TestPatternImport(PatternCommon, SavepointCase):
         self.assertEqual(pattern_file.nbr_error, 16)
         self.assertIn("Contacts require a name", pattern_file.chunk_ids.result_info)
         self.assertIn("Found more than 10 errors", pattern_file.chunk_ids.result_info)
+
+    @mute_logger("odoo.sql_db")
+    def test_import_failed_rows(self):
+        data = [
+            {"name": "foo"},
+            {"name": "", "street": "empty"},
+            {"name": "bar"},
+            {"name": "", "street": "empty 2"},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertEqual(pattern_file.state, "failed")
+        action = pattern_file.action_import_failed_rows()
+        retry = self.env["pattern.file"].browse(action["res_id"])
+        self.assertEqual(retry.origin_id, pattern_file)
+        self.assertEqual([idx for idx, _row in retry._parse_data()], [2, 4])
+        self.assertEqual(retry.state, "failed")
+        self.assertEqual(retry.nbr_error, 2)
+        self.assertEqual(
+            [message["rows"]["from"] for message in retry.chunk_ids.messages], [2, 4]
+        )
+
+    @mute_logger("odoo.sql_db")
+    def test_partial_import_bisect(self):
+        data = (
+            [{"name": "foo %s" % idx} for idx in range(20)]
+            + [{"name": "", "street": "empty"}]
+            + [{"name": "bar %s" % idx} for idx in range(20)]
+            + [{"name": "", "street": "empty"}]
+        )
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.pattern_config.bisect_retry = True
+        pattern_file_bisect = self.create_pattern(self.pattern_config, "import", data)
+        with mock.patch.object(
+            type(self.env["res.partner"]),
+            "_load_records_pattern",
+            autospec=True,
+            side_effect=type(self.env["res.partner"])._load_records_pattern,
+        ) as load_records:
+            records = self.run_pattern_file(pattern_file_bisect)
+        self.assertEqual(len(records), 40)
+        self.assertEqual(pattern_file_bisect.nbr_error, 2)
+        self.assertEqual(pattern_file_bisect.nbr_success, 40)
+        self.assertEqual(
+            pattern_file_bisect.chunk_ids.messages, pattern_file.chunk_ids.messages
+        )
+        self.assertLess(load_records.call_count, 42)
+
+    @mute_logger("odoo.sql_db")
+    def test_partial_import_bisect_too_many_error(self):
+        self.pattern_config.bisect_retry = True
+        data = (
+            [{"name": "foo"}, {"name": "bar"}]
+            + [{"name": "", "street": "empty"}] * 15
+            + [{"name": "foobar"}]
+        )
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(pattern_file.state, "failed")
+        self.assertEqual(pattern_file.nbr_error, 16)
+        self.assertIn("Contacts require a name", pattern_file.chunk_ids.result_info)
+        self.assertIn("Found more than 10 errors", pattern_file.chunk_ids.result_info)
+
+    def test_iter_json_list_by_block(self):
+        data = [{"name": "[foo], {bar}"}, {"name": "é" * 50, "ref": 12345}, 42]
+        datafile = io.BytesIO(json.dumps(data, indent=2).encode("utf-8"))
+        with mock.patch(
+            "odoo.addons.pattern_import_export.models.pattern_file.JSON_BLOCK_SIZE", 7
+        ):
+            items = list(self.env["pattern.file"]._iter_json_list(datafile))
+        self.assertEqual(items, data)
+
+    def test_iter_json_list_not_a_list(self):
+        datafile = io.BytesIO(b'{"name": "foo"}')
+        with self.assertRaises(ValueError):
+            list(self.env["pattern.file"]._iter_json_list(datafile))
+
+    def test_iter_json_list_number_by_block(self):
+        for block_size in range(1, 8):
+            datafile = io.BytesIO(b"[1e5, 123 ,-4.5]")
+            with mock.patch(
+                "odoo.addons.pattern_import_export.models.pattern_file."
+                "JSON_BLOCK_SIZE",
+                block_size,
+            ):
+                items = list(self.env["pattern.file"]._iter_json_list(datafile))
+            self.assertEqual(items, [1e5, 123, -4.5])
+
+    def test_iter_json_list_invalid(self):
+        for content in [b'[{"name": "foo"},]', b'[{"name": "foo"}]x', b"[1 2]", b"[1,"]:
+            datafile = io.BytesIO(content)
+            with self.assertRaises(ValueError):
+                list(self.env["pattern.file"]._iter_json_list(datafile))
+
+    def test_split_in_several_chunk_batch(self):
+        self.pattern_config.chunk_size = 1
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        with mock.patch(
+            "odoo.addons.pattern_import_export.models.pattern_file.CHUNK_CREATE_BATCH",
+            2,
+        ):
+            records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 5)
+        self.assertEqual(
+            [(chunk.start_idx, chunk.stop_idx) for chunk in pattern_file.chunk_ids],
+            [(1, 2), (3, 4), (5, 5)],
+        )
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+    def test_split_with_commit(self):
+        self.pattern_config.write(
+            {"chunk_size": 1, "process_multi": True, "split_commit_chunk": 1}
+        )
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 5)
+        self.assertEqual(len(pattern_file.chunk_ids), 3)
+        self.assertFalse(pattern_file.split_running)
+
+    def test_split_with_commit_concurrent_decrement(self):
+        self.pattern_config.write(
+            {"chunk_size": 1, "process_multi": True, "split_commit_chunk": 1}
+        )
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        query = "UPDATE pattern_file SET nbr_chunk_todo = nbr_chunk_todo + %s "
+        query += "WHERE id = %s"
+        commits = []
+
+        def commit():
+            # another worker enqueues a chunk after the first commit of the
+            # split and closes it after the second one
+            commits.append(True)
+            if len(commits) == 2:
+                self.env.cr.execute(query, (1, pattern_file.id))
+            elif len(commits) == 3:
+                self.env.cr.execute(query, (-1, pattern_file.id))
+
+        PatternFile = type(pattern_file)
+        with mock.patch.object(
+            self.env.cr, "commit", side_effect=commit
+        ), mock.patch.object(
+            PatternFile, "write", autospec=True, side_effect=PatternFile.write
+        ) as write:
+            records = self.run_pattern_file(pattern_file)
+        self.assertGreater(len(commits), 3)
+        # the split never writes the counter in its own transaction
+        for call in write.call_args_list:
+            if call.args[0] == pattern_file:
+                self.assertFalse(
+                    {"nbr_chunk_todo", "split_running"} & set(call.args[1])
+                )
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 5)
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+        self.assertFalse(pattern_file.split_running)
+
+    def test_split_with_commit_resume(self):
+        self.pattern_config.write(
+            {"chunk_size": 1, "process_multi": True, "split_commit_chunk": 1}
+        )
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        # simulate a split interrupted after the first chunk, the counter
+        # was incremented for the chunks rolled back after the commit
+        pattern_file.write({"split_running": True})
+        chunk = self.env["pattern.chunk"].create(
+            pattern_file._prepare_chunk(1, 2, [(1, data[0]), (2, data[1])])
+        )
+        pattern_file._add_chunk_todo(3)
+        chunk.run()
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(
+            [(chunk.start_idx, chunk.stop_idx) for chunk in pattern_file.chunk_ids],
+            [(1, 2), (3, 4), (5, 5)],
+        )
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+    def test_chunk_counter_own_cursor(self):
+        self.pattern_config.write(
+            {"chunk_size": 1, "process_multi": True, "split_commit_chunk": 1}
+        )
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        # the counter is updated by a new cursor as outside of the tests,
+        # the registry in test mode makes it share the test transaction
+        self.registry.enter_test_mode(self.env.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        with mock.patch.object(
+            self.registry, "cursor", wraps=self.registry.cursor
+        ) as cursor, mock.patch.object(threading.current_thread(), "testing", False):
+            records = self.run_pattern_file(pattern_file)
+        self.assertTrue(cursor.called)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 5)
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+        self.assertFalse(pattern_file.split_running)
+
+    def test_chunk_counter(self):
+        self.pattern_config.write({"chunk_size": 1, "process_multi": True})
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        with mock.patch.object(
+            type(pattern_file), "set_import_done", autospec=True
+        ) as set_import_done:
+            self.run_pattern_file(pattern_file)
+        set_import_done.assert_called_once()
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+    def test_chunk_run_twice(self):
+        data = [{"name": "foo %s" % idx} for idx in range(2)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        # e.g. the job is retried after the result has been committed
+        pattern_file.chunk_ids.run()
+        self.assertEqual(
+            self.env["res.partner"].search_count([("name", "=", data[0]["name"])]),
+            1,
+        )
+        self.assertEqual(len(records), 2)
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+    def test_import_waves(self):
+        self.pattern_config.write(
+            {"chunk_size": 1, "process_multi": True, "import_waves": True}
+        )
+        company, employee, assistant, other = [str(uuid4()) for _idx in range(4)]
+        data = [
+            {"name#key": company, "parent_id|name": ""},
+            {"name#key": employee, "parent_id|name": company},
+            {"name#key": assistant, "parent_id|name": employee},
+            {"name#key": other, "parent_id|name": ""},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.assertEqual(pattern_file._get_row_waves(), {2: 1, 3: 2})
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 4)
+        self.assertEqual(
+            [
+                (chunk.wave, chunk.start_idx, chunk.stop_idx)
+                for chunk in pattern_file.chunk_ids
+            ],
+            [(0, 1, 4), (1, 2, 2), (2, 3, 3)],
+        )
+        assistant = records.filtered(lambda r: r.name == assistant)
+        self.assertEqual(assistant.parent_id.parent_id.name, company)
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+    def test_import_waves_one2many(self):
+        self.pattern_config.write({"process_multi": True, "import_waves": True})
+        company, employee, other = [str(uuid4()) for _idx in range(3)]
+        data = [
+            {"ref#key": employee},
+            {"ref#key": company, "child_ids|1|ref#key": employee},
+            # the lines without key are created, they reference nothing
+            {"ref#key": other, "child_ids|1|ref": company},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.assertEqual(pattern_file._get_row_waves(), {2: 1})
+
+    def test_import_waves_sparse_keys(self):
+        self.pattern_config.write({"process_multi": True, "import_waves": True})
+        company, employee = str(uuid4()), str(uuid4())
+        # the parent row does not have the column referencing it
+        data = [
+            {"name#key": company},
+            {"name#key": employee, "parent_id|name": company},
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.assertEqual(pattern_file._get_row_waves(), {2: 1})
+
+    def test_import_partitions(self):
+        self.pattern_config.write(
+            {"chunk_size": 1, "process_multi": True, "partition_count": 2}
+        )
+        partners = self.env["res.partner"].create(
+            [{"name": "foo", "ref": str(uuid4())} for _idx in range(3)]
+        )
+        refs = partners.mapped("ref")
+        data = [
+            {"ref#key": ref, "city": "City %s" % idx}
+            for idx, ref in enumerate(refs + refs + refs[:1])
+        ]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertFalse(records)
+        self.assertEqual(partners.mapped("city"), ["City 6", "City 4", "City 5"])
+        partitions = {}
+        for chunk in pattern_file.chunk_ids:
+            self.assertLessEqual(chunk.nbr_item, 2)
+            for _idx, row in chunk.data:
+                partitions.setdefault(row["ref#key"], set()).add(chunk.partition)
+        self.assertEqual([len(partitions[ref]) for ref in refs], [1, 1, 1])
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+    def test_row_partition_keys(self):
+        self.pattern_config.write({"process_multi": True, "partition_count": 7})
+        pattern_file = self.create_pattern(self.pattern_config, "import", [])
+        rows = [
+            {"name": "foo", "ref#key": "A", "country_id#key|code": "FR"},
+            {"country_id#key|code": "FR", "ref#key": "A", "name": "bar"},
+        ]
+        partitions = {
+            pattern_file._get_row_partition(idx, row)
+            for idx, row in enumerate(rows * 4)
+        }
+        self.assertEqual(len(partitions), 1)
+        # a many2one key alone identifies the row
+        rows = [{"country_id#key|code": "FR", "name": str(idx)} for idx in range(8)]
+        partitions = {
+            pattern_file._get_row_partition(idx, row) for idx, row in enumerate(rows)
+        }
+        self.assertEqual(len(partitions), 1)
+
+    def test_adaptive_chunk_size(self):
+        self.pattern_config.chunk_byte_budget = 40
+        data = [{"name": "foo %s" % idx} for idx in range(7)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 7)
+        self.assertEqual(
+            [(chunk.start_idx, chunk.stop_idx) for chunk in pattern_file.chunk_ids],
+            [(1, 3), (4, 6), (7, 7)],
+        )
+
+        # one second per row or one2many line
+        pattern_file.chunk_ids.write({"duration": 3, "nbr_weight": 3})
+        self.pattern_config.write({"chunk_byte_budget": 0, "chunk_target_duration": 2})
+        data = [
+            {"name": "bar", "child_ids|1|name": "child"},
+            {"name": "bar 1"},
+            {"name": "bar 2"},
+            {"name": "bar 3", "child_ids|1|name": "child", "child_ids|2|name": ""},
+        ]
+        self.assertEqual(
+            [self.env["pattern.file"]._get_item_weight(item) for item in data],
+            [2, 1, 1, 2],
+        )
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(
+            [(chunk.start_idx, chunk.stop_idx) for chunk in pattern_file.chunk_ids],
+            [(1, 1), (2, 3), (4, 4)],
+        )
+        self.assertEqual(pattern_file.chunk_ids.mapped("nbr_weight"), [2, 2, 2])
+
+    def test_should_create_chunk_override(self):
+        self.pattern_config.chunk_byte_budget = 40
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        PatternFile = type(pattern_file)
+        with mock.patch.object(
+            PatternFile,
+            "_should_create_chunk",
+            lambda self, items, next_item: len(items) >= 2,
+        ):
+            self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(
+            [(chunk.start_idx, chunk.stop_idx) for chunk in pattern_file.chunk_ids],
+            [(1, 2), (3, 4), (5, 5)],
+        )
+
+        # the weight is not computed without adaptive chunk size
+        self.pattern_config.chunk_byte_budget = 0
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(set(pattern_file.chunk_ids.mapped("nbr_weight")), {0})
+
+    def test_run_chunks(self):
+        self.pattern_config.chunk_size = 1
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        PatternFile = type(pattern_file)
+        with mock.patch.object(
+            PatternFile,
+            "run_chunks",
+            autospec=True,
+            side_effect=PatternFile.run_chunks,
+        ) as run_chunks:
+            records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 5)
+        run_chunks.assert_called_once()
+
+    def test_run_chunks_interrupted_chunk(self):
+        self.pattern_config.chunk_size = 1
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        with mock.patch.object(type(pattern_file), "run_chunks"):
+            self.run_pattern_file(pattern_file)
+        # the worker died while importing the first chunk
+        pattern_file.chunk_ids[0].state = "started"
+        pattern_file.run_chunks()
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(set(pattern_file.chunk_ids.mapped("state")), {"done"})
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+    def test_run_chunks_time_limit(self):
+        self.pattern_config.chunk_size = 1
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        PatternFile = type(pattern_file)
+        with mock.patch.object(
+            PatternFile, "_get_run_chunks_time_limit", return_value=1e-9
+        ), mock.patch.object(
+            PatternFile,
+            "run_chunks",
+            autospec=True,
+            side_effect=PatternFile.run_chunks,
+        ) as run_chunks:
+            records = self.run_pattern_file(pattern_file)
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(len(records), 5)
+        # the job is enqueued again after each chunk
+        self.assertEqual(run_chunks.call_count, len(pattern_file.chunk_ids))
+
+    def test_import_inline(self):
+        self.pattern_config.write({"chunk_size": 1, "inline_import_max_row": 10})
+        data = [{"name": "foo %s" % idx} for idx in range(5)]
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.assertTrue(pattern_file._should_import_inline())
+        self.env.cr.commit.reset_mock()
+        records = self.env["res.partner"].search([])
+        pattern_file.launch_import()
+        self.env.cr.commit.assert_not_called()
+        self.assertPatternDone(pattern_file)
+        self.assertEqual(
+            len(self.env["res.partner"].search([("id", "not in", records.ids)])), 5
+        )
+        self.assertEqual(pattern_file.nbr_success, 5)
+        self.assertEqual(len(pattern_file.chunk_ids), 3)
+        self.assertEqual(pattern_file.nbr_chunk_todo, 0)
+
+        self.pattern_config.inline_import_max_row = 5
+        pattern_file = self.create_pattern(self.pattern_config, "import", data)
+        self.assertFalse(pattern_file._should_import_inline())
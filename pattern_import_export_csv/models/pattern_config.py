@@ -20,13 +20,13 @@ class PatternConfig(models.Model):
         for row in self._get_data_to_export(records):
             writer.writerow(row)
 
-    def _export_with_record_csv(self, records):
+    def _write_export_csv(self, records, output):
         self.ensure_one()
-        output = io.StringIO()
+        text_output = io.TextIOWrapper(output, encoding="utf-8", newline="")
         headers = self._get_output_headers()
         fieldnames = headers[0].keys()
         writer = csv.DictWriter(
-            output,
+            text_output,
             delimiter=self.csv_value_delimiter,
             quotechar=self.csv_quote_character,
             fieldnames=fieldnames,
@@ -34,5 +34,6 @@ class PatternConfig(models.Model):
         for line in headers:
             writer.writerow(line)
         self._csv_write_rows(writer, records)
-        output.seek(0)
-        return output.getvalue().encode("utf_8")
+        text_output.flush()
+        # the binary output is owned by the caller, do not close it
+        text_output.detach()
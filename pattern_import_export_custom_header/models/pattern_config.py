@@ -23,8 +23,8 @@ class PatternConfig(models.Model):
             for item in self.custom_header_ids
         }
 
-    def _get_data_to_export_by_record(self, record, parser):
-        data = super()._get_data_to_export_by_record(record, parser)
+    def json2pattern_format(self, data):
+        data = super().json2pattern_format(data)
         if self.header_format == "custom":
             return self._map_with_custom_header(data)
         else:
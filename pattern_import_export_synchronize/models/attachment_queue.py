@@ -20,9 +20,12 @@ class AttachmentQueue(models.Model):
                 "pattern_config_id": self.task_id.pattern_config_id.id,
             }
         )
-        pattern_file_import.with_delay().split_in_chunk()
+        pattern_file_import.launch_import()
         self.state = "done"
-        self.state_message = "Pattern file and its job has been created"
+        if pattern_file_import.state == "pending":
+            self.state_message = "Pattern file and its job has been created"
+        else:
+            self.state_message = "Pattern file has been imported"
 
     def _run(self):
         super()._run()
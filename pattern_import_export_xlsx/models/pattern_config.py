@@ -1,7 +1,7 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 # pylint: disable=missing-manifest-dependency
-from io import BytesIO
+import tempfile
 
 import openpyxl
 from openpyxl.utils import get_column_letter, quote_sheetname
@@ -19,20 +19,51 @@ class PatternConfig(models.Model):
     tab_to_import = fields.Selection(
         [("first", "First"), ("match_name", "Match Name")], default="first"
     )
+    xlsx_write_only = fields.Boolean(
+        string="Streaming Excel Export",
+        help=(
+            "Rows are written on the fly in a write-only workbook, "
+            "the memory used does not depend of the number of exported records"
+        ),
+    )
 
     # TODO we should move this code in pattern.file
-    def _create_xlsx_file(self, records):
+    def _create_xlsx_file(self, records, output=None):
+        """
+        Build the excel file
+        @param output: binary file object, a temporary file is used if empty
+        @return: the binary file object
+        """
         self.ensure_one()
-        book = openpyxl.Workbook()
-        main_sheet = self._build_main_sheet_structure(book)
-        self._populate_main_sheet_rows(main_sheet, records)
+        if self.xlsx_write_only:
+            book = openpyxl.Workbook(write_only=True)
+            main_sheet = self._build_write_only_main_sheet(book, records)
+        else:
+            book = openpyxl.Workbook()
+            main_sheet = self._build_main_sheet_structure(book)
+            self._populate_main_sheet_rows(main_sheet, records)
         tabs = self._get_metadata()["tabs"]
         self._create_tabs(book, tabs)
         self._create_validators(main_sheet, records, tabs)
+        if output is None:
+            output = tempfile.TemporaryFile()
+        book.save(output)
         book.close()
-        xlsx_file = BytesIO()
-        book.save(xlsx_file)
-        return xlsx_file
+        output.seek(0)
+        return output
+
+    def _build_write_only_main_sheet(self, book, records):
+        """
+        Write the header and append the data row by row
+        as they are exported
+        """
+        main_sheet = book.create_sheet(self.name)
+        for lines in self._get_output_headers():
+            main_sheet.append(list(lines.values()))
+        headers = self._get_header()
+        for values in self._get_data_to_export(records):
+            main_sheet.append([values.get(header, "") for header in headers])
+        return main_sheet
 
     def _build_main_sheet_structure(self, book):
         """
@@ -61,11 +92,9 @@ class PatternConfig(models.Model):
         and write all valid choices"""
         for tab_name, tab in tabs.items():
             new_sheet = book.create_sheet(tab_name)
-            for col_number, header in enumerate(tab["headers"], start=1):
-                new_sheet.cell(row=1, column=col_number, value=header)
-            for row_number, row_data in enumerate(tab["data"], start=2):
-                for col_number, cell_data in enumerate(row_data, start=1):
-                    new_sheet.cell(row=row_number, column=col_number, value=cell_data)
+            new_sheet.append(tab["headers"])
+            for row_data in tab["data"]:
+                new_sheet.append(row_data)
 
     def _create_validators(self, main_sheet, records, tabs):
         """Add validators: source permitted records from tab sheets,
@@ -91,14 +120,14 @@ class PatternConfig(models.Model):
                     str(max(main_sheet_length, 2)),
                 )
                 validation.add(range_dst)
-            main_sheet.add_data_validation(validation)
+            # write-only worksheets do not implement add_data_validation
+            main_sheet.data_validations.append(validation)
 
-    def _export_with_record_xlsx(self, records):
+    def _write_export_xlsx(self, records, output):
         """
         Export given recordset
         @param records: recordset
-        @return: string
+        @param output: binary file object
         """
         self.ensure_one()
-        excel_file = self._create_xlsx_file(records)
-        return excel_file.getvalue()
+        self._create_xlsx_file(records, output)
@@ -2,8 +2,7 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-import base64
-from io import BytesIO
+import tempfile
 
 import openpyxl
 
@@ -39,8 +38,8 @@ class PatternFile(models.Model):
             raise UserError(_("Please select a tab to import on the pattern"))
         return workbook[name]
 
-    def _parse_data_xlsx(self, data):
-        workbook = openpyxl.load_workbook(BytesIO(data), data_only=True, read_only=True)
+    def _parse_data_xlsx(self, datafile):
+        workbook = openpyxl.load_workbook(datafile, data_only=True, read_only=True)
         worksheet = self._get_worksheet(workbook)
         headers = None
         count_empty = 0
@@ -67,8 +66,8 @@ class PatternFile(models.Model):
         # TODO writing in an existing big excel file is long with openpyxl
         # maybe we should try some other tools
         # https://editpyxl.readthedocs.io
-        infile = BytesIO(base64.b64decode(self.datas))
-        wb = openpyxl.load_workbook(filename=infile)
+        with self._open_datafile() as infile:
+            wb = openpyxl.load_workbook(filename=infile)
         ws = self._get_worksheet(wb)
 
         # we clear the error col if exist
@@ -76,27 +75,33 @@ class PatternFile(models.Model):
             ws.delete_cols(1)
         ws.insert_cols(1)
         ws.cell(1, 1, value=_("#Error"))
-        last_row_idx = 0
         for chunk in self.chunk_ids:
+            last_row_idx = 0
             for message in chunk.messages:
                 if "rows" in message:
                     last_row_idx = message["rows"]["to"]
                     ws.cell(message["rows"]["to"], 1, value=message["message"].strip())
                 else:
                     # If no row are specify, this is a global message
-                    # that should be applied until the end of the chunk
-                    for idx in range(last_row_idx, chunk.stop_idx + 1):
-                        ws.cell(idx, 1, value=message["message"].strip())
-        output = BytesIO()
-        wb.save(output)
-        self.datas = base64.b64encode(output.getvalue())
+                    # that should be applied until the end of the chunk.
+                    # The rows of a chunk are not always contiguous (waves,
+                    # partitions) so only its own rows are annotated
+                    for idx, _row in chunk.data:
+                        if idx >= last_row_idx:
+                            ws.cell(idx, 1, value=message["message"].strip())
+        with tempfile.TemporaryFile() as output:
+            wb.save(output)
+            output.seek(0)
+            self.attachment_id._write_file_from_stream(output)
 
     def set_import_done(self):
         super().set_import_done()
         for record in self:
+            # the failed rows imported again are stored in json
             if (
                 record.state == "failed"
                 and record.pattern_config_id.export_format == "xlsx"
+                and not record.origin_id
             ):
                 record.write_error_in_xlsx()
         return True
@@ -147,3 +147,13 @@ class TestPatternExportExcel(CommonPatternExportExcel, PatternCaseExport):
         self.assertEqual(
             str(sheet_base.data_validations.dataValidation[0].cells), "C2:C1003"
         )
+
+
+class TestPatternExportExcelWriteOnly(TestPatternExportExcel):
+    """Run the same tests with the streaming (write-only) export"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        for el in cls.pattern_config, cls.pattern_config_m2m, cls.pattern_config_o2m:
+            el.xlsx_write_only = True
@@ -2,6 +2,7 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 import base64
+import json
 from io import BytesIO
 from os import path
 
@@ -152,6 +153,23 @@ class TestPatternImportExcel(SavepointCase):
         self.assertIsNone(ws["A4"].value)
         self.assertEqual("'Contacts require a name'", ws["A5"].value)
 
+    @mute_logger("odoo.sql_db")
+    def test_partial_import_failed_rows(self):
+        pattern_file = self._load_file(
+            "example.partners.failed.xlsx", self.pattern_config_partner
+        )
+        self.assertEqual(pattern_file.state, "failed")
+        action = pattern_file.action_import_failed_rows()
+        retry = self.env["pattern.file"].browse(action["res_id"])
+        self.assertEqual(retry.origin_id, pattern_file)
+        self.assertEqual(retry.state, "failed")
+        self.assertEqual(retry.nbr_error, 1)
+        self.assertEqual(retry.chunk_ids.messages[0]["rows"]["from"], 5)
+        # the errors are not written in the json file of the failed rows
+        self.assertEqual(
+            [idx for idx, _row in json.loads(base64.b64decode(retry.datas))], [5]
+        )
+
     @mute_logger("odoo.sql_db")
     def test_partial_import_too_many_error(self):
         pattern_file = self._load_file(